@@ -49,12 +49,22 @@ setup(name='z3c.recipe.filetemplate',
           test = [
               'zope.testing',
               'z3c.recipe.scripts',
-              ]
+              ],
+          watch = [
+              'pyinotify',
+              ],
           ),
       zip_safe=True,
       entry_points="""
       [zc.buildout]
       default = z3c.recipe.filetemplate:FileTemplate
+      reconcile = z3c.recipe.filetemplate:ReconcilingFileTemplate
+      [zc.buildout.uninstall]
+      reconcile = z3c.recipe.filetemplate:uninstall_reconciled
+      [console_scripts]
+      filetemplate-benchmark = z3c.recipe.filetemplate.benchmark:main
+      filetemplate-plan = z3c.recipe.filetemplate.plan:main
+      filetemplate-watch = z3c.recipe.filetemplate.watch:main
       """,
       include_package_data=True,
       )
@@ -12,18 +12,82 @@
 #
 ##############################################################################
 
+import atexit
+import bisect
+import collections
+import filecmp
 import fnmatch
+import hashlib
+import json
 import logging
+import mmap
 import os
+import pkg_resources
 import re
+import shutil
 import stat
 import string
 import sys
+import tempfile
+import threading
+import time
 import traceback
+from multiprocessing.pool import ThreadPool
+try:
+    from shlex import quote as _shell_quote
+except ImportError:
+    from pipes import quote as _shell_quote
 import zc.recipe.egg
 import zc.buildout
 import zc.buildout.easy_install
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Paths of the working sets resolved for the ``eggs`` option in this process,
+# by specification.  See FileTemplate._egg_paths.
+_working_set_paths = {}
+
+# Code objects of interpreted options, by expression.
+_compiled_expressions = {}
+
+# Environment variable naming the instrumentation hooks of parts that do not
+# set the ``instrumentation`` option.
+INSTRUMENTATION_VARIABLE = 'Z3C_RECIPE_FILETEMPLATE_INSTRUMENTATION'
+
+# Entry point groups from which other packages provide filters and dynamic
+# options.  They are loaded when a name is first used.
+FILTERS_GROUP = 'z3c.recipe.filetemplate.filters'
+DYNAMIC_OPTIONS_GROUP = 'z3c.recipe.filetemplate.dynamic_options'
+
+# Attribute of the buildout holding the engine shared by its parts.  See
+# _Engine.
+ENGINE_ATTRIBUTE = '_z3c_recipe_filetemplate_engine'
+
+# Changes when the output of the recipe for the same inputs changes, so that
+# older entries of render caches are not used.
+RENDER_CACHE_VERSION = '1'
+
+# Estimated seconds for each file written, placeholder resolved and byte
+# rendered, for plans.  Measured with the benchmark module.
+PLAN_COSTS = {'file': 5e-4, 'placeholder': 1.2e-5, 'byte': 5e-9}
+
+# Size of the chunks read from templates that are streamed.
+STREAM_CHUNK_SIZE = 1 << 20
+
+# Bytes of template text kept by the cache of compiled templates, which is
+# shared by all parts in a process.  See _compiled.
+COMPILED_TEMPLATES_SIZE = 16 << 20
+
+# Size of the chunks read when looking for placeholders in templates.  See
+# _placeholder_free.
+PRESCAN_CHUNK_SIZE = 1 << 16
+
 ABS_PATH_ERROR = ('%s is an absolute path. Paths must be '
                   'relative to the buildout directory.')
 
@@ -31,6 +95,7 @@ class FileTemplate(object):
 
     filters = {}
     dynamic_options = {}
+    instrumentation_hooks = {}
 
     def __init__(self, buildout, name, options):
         self.buildout = buildout
@@ -56,20 +121,67 @@ class FileTemplate(object):
                 'The relative-paths option must have the value of '
                 'true or false.')
         self.relative_paths = relative_paths = (relative_paths == 'true')
+        self.relative_path_setup = self.options.get(
+            'relative-path-setup', 'walk')
+        if self.relative_path_setup not in ('walk', 'precomputed'):
+            self._user_error(
+                'The relative-path-setup option must be walk or precomputed, '
+                'not %r.', self.relative_path_setup)
+        # Memoized by the path helpers, like _relativized.
+        self._realpaths = {}
+        self._relativized = {}
+        self._path_lists = {}
+        self._serialized = {}
+        # The option is not set from the environment, so that changing the
+        # environment does not reinstall the part.
+        self.instrumentation = self.options.get(
+            'instrumentation',
+            os.environ.get(INSTRUMENTATION_VARIABLE, '')).split()
+        for hook in self.instrumentation:
+            if hook not in self.instrumentation_hooks:
+                self._user_error('Unknown instrumentation hook: %s', hook)
+        if self.instrumentation:
+            self.stats = _Stats()
+        else:
+            self.stats = _no_stats
+        if self._bool_option('shared-engine'):
+            self.engine = _engine(buildout)
+        else:
+            self.engine = None
+        self._prerendered = {} # See _Engine.render.
+        self.incremental = self._bool_option('incremental')
+        self.fsync = self._bool_option('fsync')
+        self.mmap = self._bool_option('mmap')
+        self.static_files = self.options.get('static-files', 'copy')
+        if self.static_files not in ('copy', 'link', 'render'):
+            self._user_error(
+                'The static-files option must be copy, link or render, '
+                'not %r.', self.static_files)
+        self.stream_threshold = self._int_option(
+            'stream-threshold', '0', 0, 'a number of bytes')
+        render_cache = self.options.get('render-cache', '').strip()
+        if render_cache:
+            self.render_cache = _RenderCache(
+                os.path.join(buildout['buildout']['directory'], render_cache),
+                self._int_option('render-cache-size', '104857600', 0,
+                                 'a number of bytes'))
+        else:
+            self.render_cache = None
+        self.parallel = self._int_option('parallel', '1')
+        self.io_threads = self._int_option('io-threads', '1')
+        if self.parallel > 1 and self.io_threads > 1:
+            self._user_error(
+                'The parallel and io-threads options cannot be used together.')
+        self._directories = set() # Known to exist.  See _create_paths.
+        self.manifest_path = os.path.join(
+            buildout['buildout']['parts-directory'], name + '.manifest')
         self.paths = paths = []
         # set up paths for eggs, if given
         if 'eggs' in options:
-            eggs = zc.recipe.egg.Scripts(buildout, name, options)
-            orig_distributions, ws = eggs.working_set()
-            paths.extend(
-                zc.buildout.easy_install.realpath(dist.location)
-                for dist in ws)
-            paths.extend(
-                zc.buildout.easy_install.realpath(path)
-                for path in eggs.extra_paths)
+            paths.extend(self._egg_paths())
         else:
             paths.extend(
-                os.path.join(buildout.options['directory'], p.strip())
+                os.path.join(buildout['buildout']['directory'], p.strip())
                 for p in options.get('extra-paths', '').split('\n')
                 if p.strip()
                 )
@@ -107,43 +219,22 @@ class FileTemplate(object):
             source_patterns.append('%s.in' % filename)
         unmatched = set(source_patterns)
         unexpected_dirs = []
+        started = time.time()
         self.actions = [] # each entry is tuple of
                           # (relative path, source last-modified-time, mode)
         if self.recursive:
-            def visit(ignored, dirname, names):
-                relative_prefix = dirname[len(self.source_dir)+1:]
-                if relative_prefix in self.exclude_dirs:
-                    # exclude current directory and its subdirectories
-                    del names[:]
-                    return
-                file_info = {}
-                for name in names:
-                    val = os.path.join(relative_prefix, name)
-                    source = os.path.join(self.source_dir, val)
-                    statinfo = os.stat(source)
-                    last_modified = statinfo.st_mtime
-                    if stat.S_ISREG(statinfo.st_mode):
-                        file_info[name] = (
-                            val, last_modified, statinfo.st_mode)
-                found = set()
-                for orig_pattern in source_patterns:
-                    parts = orig_pattern.split('/')
-                    dir = os.path.sep.join(parts[:-1])
-                    pattern = parts[-1]
-                    if (dir and
-                        relative_prefix != dir and
-                        (dir != '.' or relative_prefix != '')):
-                        # if a directory is specified, it must match
-                        # precisely.  We also support the '.' directory.
-                        continue
-                    matching = fnmatch.filter(file_info, pattern)
-                    if matching:
-                        unmatched.discard(orig_pattern)
-                        found.update(matching)
-                for name in found:
-                    self.actions.append(file_info[name])
-            os.path.walk(
-                self.source_dir, visit, None)
+            matcher = _FileMatcher(source_patterns)
+            if self.engine is not None:
+                scan = self.engine.scan
+            else:
+                scan = _scan
+            for relative_prefix, files in _discover(
+                self.source_dir, matcher, _excluder(self.exclude_dirs), scan):
+                for name in matcher.match(relative_prefix, files, unmatched):
+                    statinfo = files[name]()
+                    self.actions.append(
+                        (os.path.join(relative_prefix, name),
+                         statinfo.st_mtime, statinfo.st_mode))
         else:
             for val in source_patterns:
                 source = zc.buildout.easy_install.realpath(
@@ -157,9 +248,17 @@ class FileTemplate(object):
                     else:
                         self.actions.append(
                             (val, last_modified, statinfo.st_mode))
+        self.stats.add_time('discovery', time.time() - started)
         # This is supposed to be a flag so that when source files change, the
-        # recipe knows to reinstall.
-        self.options['_actions'] = repr(self.actions)
+        # recipe knows to reinstall.  Incremental installs leave the
+        # modification times out, so that changed sources are handled by
+        # ``update`` instead.
+        if self.incremental:
+            self.options['_actions'] = repr(
+                [(rel_path, st_mode)
+                 for rel_path, last_mod, st_mode in self.actions])
+        else:
+            self.options['_actions'] = repr(self.actions)
         if unexpected_dirs:
             self._user_error(
                 'Expected file but found directory: %s',
@@ -169,11 +268,17 @@ class FileTemplate(object):
                 'No template found for these file names: %s',
                 ', '.join(unmatched))
         # parse interpreted options
+        self.lazy_interpreted_options = self._bool_option(
+            'lazy-interpreted-options')
+        self.interpreted = {} # key -> expression, evaluated on first use
+        self._interpreted_values = {}
+        self._interpreted_lock = threading.Lock()
         interpreted = self.options.get('interpreted-options')
         if interpreted:
-            globs = {'__builtins__': __builtins__, 'os': os, 'sys': sys}
-            locs = {'name': name, 'options': options, 'buildout': buildout,
-                    'paths': paths, 'all_paths': paths}
+            self._interpreted_namespace = (
+                {'__builtins__': __builtins__, 'os': os, 'sys': sys},
+                {'name': name, 'options': options, 'buildout': buildout,
+                 'paths': paths, 'all_paths': paths})
             for value in interpreted.split('\n'):
                 if value:
                     value = value.split('=', 1)
@@ -186,78 +291,679 @@ class FileTemplate(object):
                                 'Expression for key not found: %s', key)
                     else:
                         expression = value[1]
-                    try:
-                        evaluated = eval(expression, globs, locs)
-                    except:
-                        self._user_error(
-                            'Error when evaluating %r expression %r:\n%s',
-                            key, expression, traceback.format_exc())
-                    if not isinstance(evaluated, basestring):
-                        self._user_error(
-                            'Result of evaluating Python expression must be a '
-                            'string.  The result of %r expression %r was %r, '
-                            'a %s.',
-                            key, expression, evaluated, type(evaluated))
-                    options[key] = evaluated
+                    if self.lazy_interpreted_options:
+                        self.interpreted[key] = expression
+                    else:
+                        options[key] = self._interpret(key, expression)
+        if self.engine is not None:
+            self.engine.recipes[name] = self
+
+    def _interpret(self, key, expression):
+        """Evaluate the Python expression of an interpreted option."""
+        globs, locs = self._interpreted_namespace
+        try:
+            evaluated = self.stats.time(
+                'interpreted-option:%s' % key,
+                eval, _compiled_expression(expression), globs, locs)
+        except:
+            self._user_error(
+                'Error when evaluating %r expression %r:\n%s',
+                key, expression, traceback.format_exc())
+        if not isinstance(evaluated, basestring):
+            self._user_error(
+                'Result of evaluating Python expression must be a '
+                'string.  The result of %r expression %r was %r, '
+                'a %s.',
+                key, expression, evaluated, type(evaluated))
+        return evaluated
+
+    def _interpreted_value(self, key):
+        """Return the value of a lazy interpreted option, evaluating it once.
+        """
+        self._interpreted_lock.acquire()
+        try:
+            try:
+                return self._interpreted_values[key]
+            except KeyError:
+                value = self._interpreted_values[key] = self._interpret(
+                    key, self.interpreted[key])
+                return value
+        finally:
+            self._interpreted_lock.release()
+
+    def _egg_paths(self):
+        """Return the paths of the working set for ``eggs``, and extra paths.
+
+        Working sets are resolved once per process for each specification.
+        """
+        # Constructing the recipe is cheap, and sets options that buildout
+        # records, so we always do it.
+        eggs = zc.recipe.egg.Scripts(self.buildout, self.name, self.options)
+        b_options = self.buildout['buildout']
+        key = (self.options['eggs'], tuple(eggs.extra_paths),
+               self.options['executable'],
+               self.options['eggs-directory'],
+               self.options['develop-eggs-directory'],
+               tuple(eggs.links), eggs.index, eggs.allow_hosts,
+               b_options.get('offline'), b_options.get('newest'),
+               self.options.get('unzip'), eggs.include_site_packages,
+               eggs.allowed_eggs)
+        paths = _working_set_paths.get(key)
+        if paths is not None:
+            self.logger.debug('Reused the paths resolved for these eggs.')
+            return paths
+        started = time.time()
+        orig_distributions, ws = self.stats.time('eggs', eggs.working_set)
+        paths = [zc.buildout.easy_install.realpath(dist.location)
+                 for dist in ws]
+        paths.extend(
+            zc.buildout.easy_install.realpath(path)
+            for path in eggs.extra_paths)
+        _working_set_paths[key] = paths
+        self.logger.debug(
+            'Resolved the paths for these eggs in %.3f seconds.',
+            time.time() - started)
+        return paths
 
     def _user_error(self, msg, *args):
         msg = msg % args
         self.logger.error(msg)
         raise zc.buildout.UserError(msg)
 
+    def _bool_option(self, name, default='false'):
+        value = self.options.get(name, default)
+        if value not in ('true', 'false'):
+            self._user_error(
+                'The %s option must have the value of true or false.', name)
+        return value == 'true'
+
+    def _int_option(self, name, default, minimum=1,
+                    kind='a positive integer'):
+        value = self.options.get(name, default)
+        try:
+            result = int(value)
+        except ValueError:
+            result = minimum - 1
+        if result < minimum:
+            self._user_error(
+                'The %s option must be %s, not %r.', name, kind, value)
+        return result
+
     def install(self):
-        already_exists = [
-                rel_path[:-3] for rel_path, last_mod, st_mode in self.actions
-            if os.path.exists(
-                os.path.join(self.destination_dir, rel_path[:-3]))
-            ]
+        # The part may have used the reconcile recipe before.
+        _remove_deferred(self.name)
+        already_exists = self._existing_destinations()
         if already_exists:
             self._user_error(
                 'Destinations already exist: %s. Please make sure that '
                 'you really want to generate these automatically.  Then '
                 'move them away.', ', '.join(already_exists))
-        self.seen = []
-        # We throw ``seen`` away right now, but could move template
-        # processing up to __init__ if valuable.  That would mean that
-        # templates would be rewritten even if a value in another
-        # section had been referenced; however, it would also mean that
-        # __init__ would do virtually all of the work, with install only
-        # doing the writing.
+        if self.engine is not None:
+            self.engine.render()
+        # The manifest records the values each template used, so that
+        # ``update`` can render again the files whose values changed in
+        # other sections, which buildout does not know about.
+        manifest = self._process(self.actions)
+        if self.render_cache is not None:
+            self.render_cache.evict()
+        self._write_manifest(manifest)
+        self.options.created(self.manifest_path)
+        self._report()
+        return self.options.created()
+
+    def _existing_destinations(self):
+        "Return the destinations of the templates that exist already."
+        dests = [os.path.join(self.destination_dir, rel_path[:-3])
+                 for rel_path, last_mod, st_mode in self.actions]
+        if self.io_threads > 1 and len(dests) > 1:
+            pool = ThreadPool(min(self.io_threads, len(dests)))
+            try:
+                exists = pool.map(os.path.exists, dests)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            exists = [os.path.exists(dest) for dest in dests]
+        return [
+            rel_path[:-3]
+            for (rel_path, last_mod, st_mode), found in zip(
+                self.actions, exists)
+            if found]
+
+    def plan(self):
+        """Return what installing or updating the part would do.
+
+        Nothing is rendered or written.  The result can be serialized as
+        JSON: for each file, whether it would be created, updated or
+        skipped, the bytes to render, the placeholders to resolve, the
+        options it uses and those missing, and totals with an estimate of
+        the seconds it would take, from PLAN_COSTS.  When buildout would
+        install the part, or reinstall it because its options or templates
+        changed, every existing file is updated.  Otherwise, the files that
+        ``update`` would render again are.
+        """
+        manifest = self._read_manifest()
+        installed = self._installed_options()
+        reinstall = installed is not None and self._reinstalling(installed)
+        if installed is None or reinstall:
+            updated = None # All of them.
+        else:
+            updated = set(action[0] for action in self._updated(manifest))
+        files = []
+        totals = {'create': 0, 'update': 0, 'skip': 0, 'bytes': 0,
+                  'placeholders': 0}
+        cost = 0.0
         for rel_path, last_mod, st_mode in self.actions:
             source = os.path.join(self.source_dir, rel_path)
             dest = os.path.join(self.destination_dir, rel_path[:-3])
-            mode=stat.S_IMODE(st_mode)
-            # we process the file first so that it won't be created if there
-            # is a problem.
-            processed = Template(source, dest, self).substitute()
-            self._create_paths(os.path.dirname(dest))
-            result=open(dest, "wt")
-            result.write(processed)
-            result.close()
-            os.chmod(dest, mode)
-            self.options.created(rel_path[:-3])
-        return self.options.created()
+            if not os.path.exists(dest):
+                action = 'create'
+            elif updated is None or rel_path in updated:
+                action = 'update'
+            else:
+                action = 'skip'
+            nodes = _scan_placeholders(source)
+            depends = set()
+            missing = set()
+            for node in nodes:
+                if node.option is None:
+                    continue
+                section = node.section or self.name
+                if section == self.name and (
+                    node.option in self.interpreted or _registered(
+                        self.dynamic_options, DYNAMIC_OPTIONS_GROUP,
+                        node.option)):
+                    continue
+                key = '%s:%s' % (section, node.option)
+                depends.add(key)
+                if self._lookup(section, node.option) is None:
+                    missing.add(key)
+            size = os.path.getsize(source)
+            files.append({
+                'path': rel_path[:-3],
+                'action': action,
+                'bytes': size,
+                'placeholders': len(nodes),
+                'depends': sorted(depends),
+                'missing': sorted(missing),
+                })
+            totals[action] += 1
+            if action != 'skip':
+                totals['bytes'] += size
+                totals['placeholders'] += len(nodes)
+                cost += (PLAN_COSTS['file'] +
+                         PLAN_COSTS['placeholder'] * len(nodes) +
+                         PLAN_COSTS['byte'] * size)
+        return {'part': self.name, 'reinstall': reinstall, 'files': files,
+                'totals': totals, 'estimated-seconds': round(cost, 3)}
+
+    def _installed_options(self):
+        "Return the options the part was installed with, or None."
+        installed = self.buildout._read_installed_part_options()[0]
+        if self.name not in installed['buildout'].get('parts', '').split():
+            return None
+        return installed[self.name].copy()
+
+    def _reinstalling(self, installed):
+        """Would buildout reinstall the part, rather than update it?
+
+        As buildout does, the options the part was installed with are
+        compared with the current ones, and the files it installed must
+        still exist.
+        """
+        old = dict(installed)
+        files = old.pop('__buildout_installed__', '')
+        old.pop('__buildout_signature__', None)
+        new = self.options.copy()
+        new.pop('__buildout_signature__', None)
+        if old != new:
+            return True
+        directory = self.buildout['buildout']['directory']
+        return bool([path for path in files.split('\n') if path and
+                     not os.path.exists(os.path.join(directory, path))])
+
+    def _process(self, actions):
+        """Render and write the templates of ``actions``.
+
+        Return a dict mapping their relative paths to manifest entries.
+        """
+        manifest = {}
+        writer = _Writer(self.fsync)
+        try:
+            if self.parallel == 1 and self.io_threads > 1 and len(actions) > 1:
+                self._process_pipelined(writer, actions, manifest)
+            elif self.parallel == 1 or len(actions) < 2:
+                for rel_path, last_mod, st_mode in actions:
+                    # we process the file first so that it won't be created
+                    # if there is a problem.
+                    template, processed = self._render(rel_path)
+                    self._create_paths(os.path.dirname(
+                        os.path.join(self.destination_dir, rel_path[:-3])))
+                    output = self._stage(
+                        writer, rel_path, template, processed, st_mode)
+                    manifest[rel_path] = self._manifest_entry(
+                        template, output)
+            else:
+                self._process_in_parallel(writer, actions, manifest)
+            for rel_path, last_mod, st_mode in actions:
+                self.options.created(rel_path[:-3])
+            self.stats.time('commit', writer.commit)
+        finally:
+            writer.abort()
+        self.stats.count('files-written', writer.written)
+        self.stats.count('files-unchanged', writer.unchanged)
+        self.stats.count('files-copied', writer.copied)
+        self.stats.count('bytes-written', writer.bytes_written)
+        self.logger.debug(
+            'Wrote %d files, left %d unchanged.',
+            writer.written, writer.unchanged)
+        if writer.copied:
+            self.logger.debug(
+                'Copied %d files without placeholders.', writer.copied)
+        return manifest
+
+    def _process_in_parallel(self, writer, actions, manifest):
+        pool = ThreadPool(min(self.parallel, len(actions)))
+        try:
+            rendered = pool.map(
+                lambda action: _call_safely(self._render, action[0]),
+                actions)
+            # Report the first failure in action order, before anything is
+            # written.
+            _raise_first_error(rendered)
+            for rel_path, last_mod, st_mode in actions:
+                self._create_paths(os.path.dirname(
+                    os.path.join(self.destination_dir, rel_path[:-3])))
+            outputs = pool.map(
+                lambda args: _call_safely(self._stage, writer, *args),
+                [(rel_path, template, processed, st_mode)
+                 for (rel_path, last_mod, st_mode), (template, processed)
+                 in zip(actions, rendered)])
+            _raise_first_error(outputs)
+        finally:
+            pool.close()
+            pool.join()
+        for (rel_path, last_mod, st_mode), (template, processed), output in (
+            zip(actions, rendered, outputs)):
+            manifest[rel_path] = self._manifest_entry(template, output)
+
+    def _process_pipelined(self, writer, actions, manifest):
+        """Render templates in order, while threads write those rendered.
+
+        Errors are reported as when rendering and writing one file after
+        the other: a failure to write a file is reported rather than that
+        of rendering a later one.
+        """
+        pool = ThreadPool(min(self.io_threads, len(actions)))
+        try:
+            templates = []
+            pending = []
+            for rel_path, last_mod, st_mode in actions:
+                rendered = _call_safely(self._render, rel_path)
+                if isinstance(rendered, BaseException):
+                    _raise_first_error([result.get() for result in pending])
+                    raise rendered
+                template, processed = rendered
+                self._create_paths(os.path.dirname(
+                    os.path.join(self.destination_dir, rel_path[:-3])))
+                templates.append(template)
+                pending.append(pool.apply_async(
+                    _call_safely, (self._stage, writer, rel_path, template,
+                                   processed, st_mode)))
+            outputs = [result.get() for result in pending]
+            _raise_first_error(outputs)
+        finally:
+            pool.close()
+            pool.join()
+        for (rel_path, last_mod, st_mode), template, output in zip(
+            actions, templates, outputs):
+            manifest[rel_path] = self._manifest_entry(template, output)
+
+    def _render(self, rel_path):
+        """Return the template for ``rel_path`` and its result.
+
+        Templates of at least ``stream-threshold`` bytes are not rendered
+        here but streamed when they are written, so the result is None.
+        """
+        source = os.path.join(self.source_dir, rel_path)
+        prerendered = self._prerendered.pop(rel_path, None)
+        if prerendered is not None:
+            mtime, result = prerendered
+            if mtime is not None and mtime == _mtime(source):
+                if isinstance(result, BaseException):
+                    raise result
+                return result
+            # else the template changed since; render it again.
+        dest = os.path.join(self.destination_dir, rel_path[:-3])
+        if self.static_files != 'render':
+            found = _placeholder_free(source)
+            if found is not None:
+                return _StaticFile(source, found[0], found[1]), None
+        if (self.stream_threshold and
+            os.path.getsize(source) >= self.stream_threshold):
+            if self.mmap:
+                return MappedTemplate(source, dest, self), None
+            return StreamingTemplate(source, dest, self), None
+        template = Template(source, dest, self)
+        if self.render_cache is None:
+            return template, self.stats.time('render', template.substitute)
+        key = self._cache_key(template)
+        if key is not None:
+            processed = self.render_cache.get(key)
+            if processed is not None:
+                self.stats.count('render-cache-hits')
+                return template, processed
+            self.stats.count('render-cache-misses')
+        processed = self.stats.time('render', template.substitute)
+        if key is not None:
+            self.render_cache.put(key, processed)
+        return template, processed
+
+    def _cache_key(self, template):
+        """Return the key of the result of ``template`` in the render cache.
+
+        The key is a hash of the template, of the values of the options it
+        uses, and of what filters and dynamic options depend on: the paths,
+        and, for relative paths, the buildout and destination directories.
+        Return None if the template has invalid placeholders.
+        """
+        digest = hashlib.md5()
+        context = [RENDER_CACHE_VERSION, self.relative_paths, self.paths]
+        if self.relative_paths:
+            context.extend([self.buildout_root, template.destination,
+                            self.relative_path_setup])
+        digest.update(repr(context))
+        digest.update(template.template)
+        done = set()
+        for node in template.nodes:
+            if isinstance(node, basestring):
+                continue
+            if node.option is None:
+                return None
+            section = node.section or self.name
+            if (section, node.option) in done:
+                continue
+            done.add((section, node.option))
+            if section == self.name and _registered(
+                self.dynamic_options, DYNAMIC_OPTIONS_GROUP, node.option):
+                continue # It depends on the context only.
+            digest.update(repr(
+                (section, node.option,
+                 template._get(node.section, node.option, node.start))))
+        return digest.hexdigest()
+
+    def _stage(self, writer, rel_path, template, processed, st_mode):
+        "Stage the result of a template.  Return its size and digest."
+        dest = os.path.join(self.destination_dir, rel_path[:-3])
+        mode = stat.S_IMODE(st_mode)
+        if isinstance(template, _StaticFile):
+            self.stats.time(
+                'write', writer.add_copy, dest, template.source, mode,
+                self.static_files == 'link')
+            return [template.size, template.digest]
+        if processed is None:
+            return self.stats.time(
+                'write', writer.add_stream, dest, template.stream, mode)
+        self.stats.time('write', writer.add, dest, processed, mode)
+        return [len(processed), _digest(processed)]
+
+    def _manifest_entry(self, template, output):
+        statinfo = os.stat(template.source)
+        return {
+            'source': [statinfo.st_mtime, statinfo.st_size,
+                       template.source_digest()],
+            'depends': dict((key, _value_digest(value))
+                            for key, value in template.depends.items()),
+            'output': output,
+            }
 
     def _create_paths(self, path):
+        if path in self._directories:
+            return
         if not os.path.exists(path):
             self._create_paths(os.path.dirname(path))
             os.mkdir(path)
             self.options.created(path)
+        self._directories.add(path)
 
-    def _call_and_log(self, callable, args, message_generator):
+    def _call_and_log(self, template, start, callable, args,
+                      message_generator):
         try:
             return callable(*args)
         except (KeyboardInterrupt, SystemExit):
             raise
         except:
             # Argh.  Would like to raise wrapped exception.
-            colno, lineno = self.get_colno_lineno(start)
+            colno, lineno = template.get_colno_lineno(start)
             msg = message_generator(lineno, colno)
             self.logger.error(msg, exc_info=True)
             raise
 
+    def _report(self):
+        "Pass the summary of the instrumentation to its hooks."
+        if not self.instrumentation:
+            return
+        summary = self.stats.summary()
+        summary['part'] = self.name
+        for hook in self.instrumentation:
+            self.instrumentation_hooks[hook](self, summary)
+
     def update(self):
-        pass
+        manifest = self._read_manifest()
+        changed = self._updated(manifest)
+        if changed:
+            manifest.update(self._process(changed))
+            if self.render_cache is not None:
+                self.render_cache.evict()
+        if changed or self.incremental:
+            self._write_manifest(manifest)
+        self.logger.debug(
+            'Rendered %d of %d files.', len(changed), len(self.actions))
+        self._report()
+        # Buildout adds files created now, like the summary of the
+        # instrumentation, to those installed with the part.
+        return self.options.created()
+
+    def _updated(self, manifest):
+        "Return the actions whose files ``update`` renders again."
+        if self.incremental:
+            return self._outdated(self.actions, manifest)
+        # Changed templates reinstall the part, so only the values they use
+        # from other sections can have changed.  Parts installed without a
+        # manifest are left alone.
+        return [action for action in self.actions
+                if action[0] in manifest and
+                self._depends_changed(manifest[action[0]])]
+
+    def refresh(self, sources=None):
+        """Render the templates whose files are out of date, and return them.
+
+        As with ``incremental``, templates are rendered again when they, the
+        values they use or their output changed since the manifest was
+        written.  Only the templates whose paths are in ``sources`` are
+        checked, if given.  Return the relative paths of those rendered.
+
+        Templates missing from the manifest are not rendered: their files
+        would not be part of the install, and buildout would refuse to
+        overwrite them.  Buildout has to be run to install them.
+        """
+        manifest = self._read_manifest()
+        actions = self.actions
+        if sources is not None:
+            actions = [action for action in actions
+                       if os.path.join(self.source_dir, action[0]) in sources]
+        added = [action[0] for action in actions if action[0] not in manifest]
+        if added:
+            self.logger.warning(
+                'Run buildout to install the files of these new templates: %s',
+                ' '.join(added))
+            actions = [action for action in actions if action[0] in manifest]
+        changed = self._outdated(actions, manifest)
+        if changed:
+            manifest.update(self._process(changed))
+            if self.render_cache is not None:
+                self.render_cache.evict()
+            self._write_manifest(manifest)
+        return [action[0] for action in changed]
+
+    def _outdated(self, actions, manifest):
+        "Return the actions whose files are missing from or changed in it."
+        return [action for action in actions
+                if action[0] not in manifest or
+                self._changed(action[0], manifest[action[0]])]
+
+    def _changed(self, rel_path, entry):
+        "Do the inputs or the output recorded in ``entry`` differ now?"
+        source = os.path.join(self.source_dir, rel_path)
+        mtime, size, digest = entry['source']
+        statinfo = os.stat(source)
+        if statinfo.st_size != size:
+            return True
+        if statinfo.st_mtime != mtime:
+            if _file_digest(source) != digest:
+                return True
+            entry['source'][0] = statinfo.st_mtime
+        if self._depends_changed(entry):
+            return True
+        dest = os.path.join(self.destination_dir, rel_path[:-3])
+        try:
+            return os.path.getsize(dest) != entry['output'][0]
+        except OSError:
+            return True
+
+    def _depends_changed(self, entry):
+        "Did any value used by the template of ``entry`` change?"
+        for key, digest in entry['depends'].items():
+            section, option = key.split(':', 1)
+            value = self._lookup(section, option)
+            if value is None or _value_digest(value) != digest:
+                return True
+        return False
+
+    def _lookup(self, section, option):
+        if section == self.name:
+            return self.options.get(option)
+        if section in self.buildout:
+            return self.buildout[section].get(option)
+        return None
+
+    def _read_manifest(self):
+        try:
+            f = open(self.manifest_path)
+        except IOError:
+            return {}
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+
+    def _write_manifest(self, manifest):
+        # Written aside and renamed, so that a failure leaves the previous
+        # manifest intact.
+        fd, path = tempfile.mkstemp(
+            dir=os.path.dirname(self.manifest_path), suffix='.manifest')
+        try:
+            f = os.fdopen(fd, 'w')
+            try:
+                json.dump(manifest, f)
+            finally:
+                f.close()
+            os.rename(path, self.manifest_path)
+        except:
+            os.remove(path)
+            raise
+
+
+class ReconcilingFileTemplate(FileTemplate):
+    """The ``reconcile`` recipe.
+
+    When buildout reinstalls a part of this recipe, its uninstaller leaves
+    the files of the part in place (see uninstall_reconciled), and
+    installing reconciles them: files of templates that are gone are
+    removed, changed ones are replaced atomically and identical ones are
+    left alone.  Files of the previous install are not reported as
+    existing destinations.
+    """
+
+    _previous = ()
+
+    def install(self):
+        previous = _deferred.pop(self.name, ())
+        self._previous = set(previous)
+        try:
+            created = FileTemplate.install(self)
+        except:
+            # Leave them for _remove_all_deferred, as for a failed install
+            # after a usual uninstall.
+            _deferred[self.name] = previous
+            raise
+        current = set(os.path.abspath(path) for path in created)
+        gone = []
+        for path in previous:
+            if path in current:
+                continue
+            if [other for other in current
+                if other.startswith(os.path.join(path, ''))]:
+                # A directory that the previous install created, and that
+                # holds files of this one.  It is still ours to remove.
+                self.options.created(path)
+            else:
+                gone.append(path)
+                _remove(path)
+        self.logger.debug(
+            'Reconciled %d files of the previous install, removed %d.',
+            len(previous), len(gone))
+        return self.options.created()
+
+    def _existing_destinations(self):
+        return [
+            path for path in FileTemplate._existing_destinations(self)
+            if os.path.abspath(path) not in self._previous]
+
+
+# Files of uninstalled parts of the reconcile recipe, as absolute paths, by
+# part name.  Buildout uninstalls parts before installing any, so they are
+# left for the install of the part, or removed at exit if there is none.
+_deferred = {}
+
+def uninstall_reconciled(name, options):
+    """Uninstall a part of the ``reconcile`` recipe, leaving its files.
+
+    Buildout removes the files of a part after calling its uninstaller, so
+    they are taken from its list.  Buildout runs in the buildout directory,
+    where relative paths are.
+    """
+    _deferred[name] = [
+        os.path.abspath(path)
+        for path in options.get('__buildout_installed__', '').split('\n')
+        if path]
+    options['__buildout_installed__'] = ''
+
+def _remove_deferred(name):
+    for path in _deferred.pop(name, ()):
+        _remove(path)
+
+def _remove_all_deferred():
+    for name in list(_deferred):
+        _remove_deferred(name)
+atexit.register(_remove_all_deferred)
+
+def _remove(path):
+    "Remove a file or directory, as buildout does when uninstalling."
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.isfile(path):
+        os.remove(path)
+
+
+def _compiled_expression(expression):
+    try:
+        return _compiled_expressions[expression]
+    except KeyError:
+        # eval ignores leading whitespace in strings, but compile does not.
+        code = _compiled_expressions[expression] = compile(
+            expression.strip(), '<string>', 'eval')
+        return code
 
 
 class Template:
@@ -281,29 +987,46 @@ class Template:
         self.source = source
         self.destination = zc.buildout.easy_install.realpath(destination)
         self.recipe = recipe
-        self.template = open(source).read()
+        self.template, self.nodes = _compiled(source, recipe.stats)
+        self._line_ends = None # See get_colno_lineno.
+        # Maps 'section:option' to the value used, for updates.
+        self.depends = {}
+        # Templates may be rendered concurrently, so each needs its own list
+        # for buildout's detection of circular references.
+        self.seen = []
+        for node in self.nodes:
+            if not isinstance(node, basestring):
+                self._resolve_filters(node)
+
+    def source_digest(self):
+        return _digest(self.template)
 
     def get_colno_lineno(self, i):
-        lines = self.template[:i].splitlines(True)
-        if not lines:
-            colno = 1
-            lineno = 1
-        else:
-            colno = len(lines[-1]) + 1
-            lineno = len(lines)
-        return colno, lineno
+        ends = self._line_ends
+        if ends is None:
+            ends = self._line_ends = _line_breaks(self.template)
+        breaks = bisect.bisect_right(ends, i)
+        if breaks > 1:
+            return _colno_lineno(i, breaks, ends[breaks - 1], ends[breaks - 2])
+        elif breaks:
+            return _colno_lineno(i, breaks, ends[0], 0)
+        return _colno_lineno(i, 0, 0, 0)
 
     def _get(self, section, option, start):
         if section is None:
             section = self.recipe.name # This sets up error messages properly.
         if section == self.recipe.name:
-            factory = self.recipe.dynamic_options.get(option)
+            factory = _registered(
+                self.recipe.dynamic_options, DYNAMIC_OPTIONS_GROUP, option)
             if factory is not None:
-                return self.recipe._call_and_log(
-                    factory, (self, start, option),
+                return self.recipe.stats.time(
+                    'dynamic-option:%s' % option, self.recipe._call_and_log,
+                    self, start, factory, (self, start, option),
                     lambda lineno, colno: (
                         'Dynamic option %r in line %d, col %d of %s '
                         'crashed.') % (option, lineno, colno, self.source))
+            if option in self.recipe.interpreted:
+                return self.recipe._interpreted_value(option)
             # else...
             options = self.recipe.options
         elif section in self.recipe.buildout:
@@ -311,62 +1034,1195 @@ class Template:
         else:
             value = options = None
         if options is not None:
-            value = options.get(option, None, self.recipe.seen)
+            value = options.get(option, None, self.seen)
         if value is None:
             colno, lineno = self.get_colno_lineno(start)
             raise zc.buildout.buildout.MissingOption(
                 "Option '%s:%s', referenced in line %d, col %d of %s, "
                 "does not exist." %
                 (section, option, lineno, colno, self.source))
+        self.depends['%s:%s' % (section, option)] = value
         return value
 
+    def _evaluate(self, node):
+        start = node.start
+        if node.option is None:
+            colno, lineno = self.get_colno_lineno(start)
+            raise ValueError(
+                'Invalid placeholder %r in line %d, col %d of %s' %
+                (node.invalid, lineno, colno, self.source))
+        self.recipe.stats.count('placeholders')
+        val = self._get(node.section, node.option, start)
+        if node.path_extension is not None:
+            val = os.path.join(val, *node.path_extension.split('/')[1:])
+        if node.pipeline is not None:
+            val = node.pipeline(val, self, start)
+        # We use this idiom instead of str() because the latter will
+        # fail if val is a Unicode containing non-ASCII characters.
+        return '%s' % (val,)
+
+    def _resolve_filters(self, node):
+        "Set the composed filter chain of ``node``, checking its filters."
+        if node.filters is None or node.pipeline is not None:
+            return
+        try:
+            node.pipeline = _pipeline(node.filters, self.recipe.filters)
+        except LookupError:
+            colno, lineno = self.get_colno_lineno(node.start)
+            raise ValueError(
+                'Unknown filter %r '
+                'in line %d, col %d of %s' %
+                (sys.exc_info()[1].args[0], lineno, colno, self.source))
+
     def substitute(self):
-        def convert(mo):
-            start = mo.start()
-            # Check the most common path first.
-            option = mo.group('option')
-            if option is not None:
-                section = mo.group('section')
-                val = self._get(section, option, start)
-                path_extension = mo.group('path_extension')
-                filters = mo.group('filters')
-                if path_extension is not None:
-                    val = os.path.join(val, *path_extension.split('/')[1:])
-                if filters is not None:
-                    for filter_name in filters.split('|')[1:]:
-                        filter_name = filter_name.strip()
-                        filter = self.recipe.filters.get(filter_name)
-                        if filter is None:
-                            colno, lineno = self.get_colno_lineno(start)
-                            raise ValueError(
-                                'Unknown filter %r '
-                                'in line %d, col %d of %s' %
-                                (filter_name, lineno, colno, self.source))
-                        val = self.recipe._call_and_log(
-                            filter, (val, self, start, filter_name),
-                            lambda lineno, colno: (
-                                'Filter %r in line %d, col %d of %s '
-                                'crashed processing value %r') % (
-                                filter_name, lineno, colno, self.source, val))
-                # We use this idiom instead of str() because the latter will
-                # fail if val is a Unicode containing non-ASCII characters.
-                return '%s' % (val,)
-            escaped = mo.group('escaped')
-            if escaped is not None:
-                return '${%s}' % (escaped,)
-            invalid = mo.group('invalid')
-            if invalid is not None:
-                colno, lineno = self.get_colno_lineno(mo.start('invalid'))
-                raise ValueError(
-                    'Invalid placeholder %r in line %d, col %d of %s' %
-                    (mo.group('invalid'), lineno, colno, self.source))
-            raise ValueError('Unrecognized named group in pattern',
-                             self.pattern) # programmer error, AFAICT
-        return self.pattern.sub(convert, self.template)
+        result = []
+        for node in self.nodes:
+            if isinstance(node, basestring):
+                result.append(node)
+            else:
+                result.append(self._evaluate(node))
+        return ''.join(result)
+
+
+# Used to find where a placeholder may start at the end of a chunk: a dollar
+# sign followed by an opening brace, or by the end of the text.
+_PLACEHOLDER_START = re.compile(r'\$(?:\$?\{|\$?\Z)')
+
+class StreamingTemplate(Template):
+    """A template rendered chunk by chunk, for very large files.
+
+    ``stream`` reads the source in chunks of STREAM_CHUNK_SIZE and passes
+    the output to a write function as it goes, so neither the template nor
+    the result is ever held in memory as a whole.  Placeholders that span
+    chunks are kept back until the rest of them has been read.
+    """
+
+    def __init__(self, source, destination, recipe):
+        self.source = source
+        self.destination = zc.buildout.easy_install.realpath(destination)
+        self.recipe = recipe
+        self.template = self.nodes = None
+        self.depends = {}
+        self.seen = []
+        self._digest = None
+        # The text being rendered, its position in the template, the line
+        # breaks before it (see _colno_lineno), and the offsets just after
+        # the line breaks in it, found when first needed.
+        self._text = ''
+        self._offset = 0
+        self._breaks = self._last_end = self._prev_end = 0
+        self._chunk_ends = None
+
+    def source_digest(self):
+        return self._digest
+
+    def get_colno_lineno(self, i):
+        ends = self._chunk_ends
+        if ends is None:
+            ends = self._chunk_ends = _line_breaks(self._text)
+        breaks = bisect.bisect_right(ends, i - self._offset)
+        if not breaks:
+            return _colno_lineno(
+                i, self._breaks, self._last_end, self._prev_end)
+        if breaks > 1:
+            prev_end = self._offset + ends[breaks - 2]
+        else:
+            prev_end = self._last_end
+        return _colno_lineno(
+            i, self._breaks + breaks, self._offset + ends[breaks - 1],
+            prev_end)
+
+    def stream(self, write):
+        digest = hashlib.md5()
+        f = open(self.source)
+        try:
+            pending = ''
+            while True:
+                chunk = f.read(STREAM_CHUNK_SIZE)
+                digest.update(chunk)
+                text = pending + chunk
+                if chunk:
+                    end = text.rfind('}') + 1
+                    mo = _PLACEHOLDER_START.search(text, end)
+                    if mo is not None:
+                        end = mo.start()
+                    else:
+                        end = len(text)
+                    if text[end - 1:end] == '\r':
+                        end -= 1 # Keep "\r\n" together for line counting.
+                else:
+                    end = len(text)
+                self._render(text, end, write)
+                pending = text[end:]
+                if not chunk:
+                    break
+        finally:
+            f.close()
+        self._digest = digest.hexdigest()
+
+    def _render(self, text, end, write):
+        "Render ``text`` up to ``end``, and advance past it."
+        self._text = text
+        self._chunk_ends = None
+        start = 0
+        for mo in self.pattern.finditer(text, 0, end):
+            write(text[start:mo.start()])
+            start = mo.end()
+            node = _node(mo, self._offset)
+            if isinstance(node, basestring):
+                write(node)
+            else:
+                self._resolve_filters(node)
+                write(self._evaluate(node))
+        write(text[start:end])
+        breaks = (text.count('\n', 0, end) + text.count('\r', 0, end) -
+                  text.count('\r\n', 0, end))
+        if breaks:
+            last_start, last_end = _last_line_break(text, end)
+            if breaks > 1:
+                self._prev_end = (
+                    self._offset + _last_line_break(text, last_start)[1])
+            else:
+                self._prev_end = self._last_end
+            self._last_end = self._offset + last_end
+            self._breaks += breaks
+        self._offset += end
+
+
+try:
+    _span = buffer # A view on part of a mapping, without copying it.
+except NameError:
+    def _span(obj, offset, size):
+        return memoryview(obj)[offset:offset + size]
+
+class MappedTemplate(StreamingTemplate):
+    """A streamed template that is memory-mapped instead of read in chunks.
+
+    Placeholders are searched for in the mapping, and literal text is
+    written straight from it, so only substituted values are copied.
+    """
+
+    def get_colno_lineno(self, i):
+        return Template.get_colno_lineno(self, i)
+
+    def stream(self, write):
+        f = open(self.source, 'rb')
+        try:
+            try:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError: # An empty file cannot be mapped.
+                return StreamingTemplate.stream(self, write)
+            try:
+                self.template = mapping
+                self._line_ends = None
+                start = 0
+                for mo in self.pattern.finditer(mapping):
+                    if mo.start() > start:
+                        write(_span(mapping, start, mo.start() - start))
+                    start = mo.end()
+                    node = _node(mo)
+                    if isinstance(node, basestring):
+                        write(node)
+                    else:
+                        self._resolve_filters(node)
+                        write(self._evaluate(node))
+                if len(mapping) > start:
+                    write(_span(mapping, start, len(mapping) - start))
+                self._digest = hashlib.md5(mapping).hexdigest()
+            finally:
+                self.template = self._line_ends = None
+                mapping.close()
+        finally:
+            f.close()
+
+
+class _StaticFile(object):
+    """A template without placeholders, which is copied rather than rendered.
+
+    It stands in for the template in manifests.
+    """
+
+    def __init__(self, source, size, digest):
+        self.source = source
+        self.size = size
+        self.digest = digest
+        self.depends = {}
+
+    def source_digest(self):
+        return self.digest
+
+
+def _scan_placeholders(path):
+    """Return the placeholder nodes of the template at ``path``.
+
+    The template is memory-mapped, so only the nodes are kept in memory.
+    """
+    f = open(path, 'rb')
+    try:
+        try:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # An empty file cannot be mapped.
+            return []
+        try:
+            nodes = []
+            for mo in Template.pattern.finditer(mapping):
+                node = _node(mo)
+                if not isinstance(node, basestring):
+                    nodes.append(node)
+            return nodes
+        finally:
+            mapping.close()
+    finally:
+        f.close()
+
+
+def _placeholder_free(path):
+    """Return the size and digest of ``path`` if it has no dollar signs.
+
+    Otherwise, return None, usually after reading only its beginning.
+    """
+    digest = hashlib.md5()
+    size = 0
+    f = open(path, 'rb')
+    try:
+        while True:
+            data = f.read(PRESCAN_CHUNK_SIZE)
+            if not data:
+                break
+            if '$' in data:
+                return None
+            digest.update(data)
+            size += len(data)
+    finally:
+        f.close()
+    return size, digest.hexdigest()
+
+
+class _Placeholder(object):
+    """A substitution found when compiling a template.
+
+    ``option`` is None for an ill-formed ``${...}`` expression, in which case
+    ``invalid`` holds its text and ``start`` points at it.  ``pipeline`` is
+    the composed filter chain, set by Template._resolve_filters.
+    """
+    __slots__ = ('section', 'option', 'path_extension', 'filters', 'start',
+                 'invalid', 'pipeline')
+
+    def __init__(self, section, option, path_extension, filters, start,
+                 invalid=None):
+        self.section = section
+        self.option = option
+        self.path_extension = path_extension
+        self.filters = filters
+        self.start = start
+        self.invalid = invalid
+        self.pipeline = None
+
+
+def _node(mo, offset=0):
+    """Return the node for a match of Template.pattern.
+
+    Escaped sequences are returned as literal strings.  ``offset`` is added
+    to positions, for matches in a part of the template.
+    """
+    escaped = mo.group('escaped')
+    if escaped is not None:
+        return '${%s}' % (escaped,)
+    option = mo.group('option')
+    if option is not None:
+        return _Placeholder(
+            mo.group('section'), option, mo.group('path_extension'),
+            mo.group('filters'), offset + mo.start())
+    return _Placeholder(
+        None, None, None, None, offset + mo.start('invalid'),
+        mo.group('invalid'))
+
+def _compile(template):
+    """Split a template into literal strings and _Placeholder nodes.
+
+    Escaped ``$${...}`` sequences become part of the literal text, and
+    adjacent literals are merged.
+    """
+    nodes = []
+    literal = []
+    end = 0
+    for mo in Template.pattern.finditer(template):
+        literal.append(template[end:mo.start()])
+        end = mo.end()
+        node = _node(mo)
+        if isinstance(node, basestring):
+            literal.append(node)
+            continue
+        if literal:
+            nodes.append(''.join(literal))
+            literal = []
+        nodes.append(node)
+    literal.append(template[end:])
+    literal = ''.join(literal)
+    if literal:
+        nodes.append(literal)
+    return nodes
+
+def _colno_lineno(i, breaks, last_end, prev_end):
+    """Return the column and line of position ``i`` in a template.
+
+    ``breaks`` is the number of line breaks before ``i``, ``last_end`` the
+    position just after the last of them and ``prev_end`` the position just
+    after the one before (both 0 if there is no such break).  The result is
+    the same as splitting the template up to ``i`` into lines: a position
+    just after a line break counts as the end of that line.
+    """
+    if breaks and last_end == i:
+        return i - prev_end + 1, breaks
+    return i - last_end + 1, breaks + 1
+
+def _last_line_break(text, end):
+    "Return the start and end of the last line break in ``text[:end]``."
+    i = max(text.rfind('\n', 0, end), text.rfind('\r', 0, end))
+    if i == -1:
+        return None
+    if text[i] == '\n' and text[i - 1:i] == '\r':
+        return i - 1, i + 1
+    return i, i + 1
+
+_LINE_BREAK = re.compile(r'\r\n?|\n')
+
+def _line_breaks(text):
+    "Return the offsets just after each line break in ``text``."
+    return [mo.end() for mo in _LINE_BREAK.finditer(text)]
+
+def _digest(text):
+    return hashlib.md5(text).hexdigest()
+
+def _value_digest(value):
+    """Return the digest of an option value, as recorded in manifests.
+
+    Values are recorded as digests, so that any bytes can be, and unicode
+    values are encoded as UTF-8 first, so that both compare alike.
+    """
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return _digest(value)
+
+def _file_digest(path):
+    digest = hashlib.md5()
+    f = open(path)
+    try:
+        while True:
+            data = f.read(STREAM_CHUNK_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+class _CompiledTemplates(object):
+    """Compiled templates shared by all parts in a process, by source path.
+
+    Entries are only used while the mtime and size of their source are the
+    same.  The least recently used ones are dropped when the texts held add
+    up to more than ``size`` bytes, and larger templates are not kept.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.held = 0
+        # Maps a source path to (mtime, size, template text, nodes), least
+        # recently used first.
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, source, statinfo):
+        "Return the text and nodes of ``source``, or None."
+        self.lock.acquire()
+        try:
+            cached = self.entries.pop(source, None)
+            if cached is None:
+                return None
+            if (cached[0] != statinfo.st_mtime or
+                cached[1] != statinfo.st_size):
+                self.held -= len(cached[2])
+                return None
+            self.entries[source] = cached
+            return cached[2:]
+        finally:
+            self.lock.release()
+
+    def put(self, source, statinfo, template, nodes):
+        if len(template) > self.size:
+            return
+        self.lock.acquire()
+        try:
+            cached = self.entries.pop(source, None)
+            if cached is not None:
+                self.held -= len(cached[2])
+            self.entries[source] = (
+                statinfo.st_mtime, statinfo.st_size, template, nodes)
+            self.held += len(template)
+            while self.held > self.size:
+                self.held -= len(self.entries.popitem(last=False)[1][2])
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.held = 0
+        finally:
+            self.lock.release()
+
+_compiled_templates = _CompiledTemplates(COMPILED_TEMPLATES_SIZE)
+
+def _compiled(source, stats):
+    "Return the text and compiled nodes of ``source``, using the cache."
+    statinfo = os.stat(source)
+    cached = _compiled_templates.get(source, statinfo)
+    if cached is not None:
+        stats.count('template-cache-hits')
+        return cached
+    stats.count('template-cache-misses')
+    template = open(source).read()
+    nodes = _compile(template)
+    _compiled_templates.put(source, statinfo, template, nodes)
+    return template, nodes
+
+
+############################################################################
+# Instrumentation
+class _Stats(object):
+    """Times and counters of the work of a part, for instrumentation hooks.
+
+    Timers are named by phase, like ``render``, or by the filter, dynamic
+    option or interpreted option that was timed, like ``filter:upper``.
+    """
+
+    def __init__(self):
+        self.timers = {} # name -> [calls, seconds]
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def time(self, name, func, *args):
+        "Call ``func`` with ``args``, and add the time it took to ``name``."
+        started = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.add_time(name, time.time() - started)
+
+    def add_time(self, name, seconds):
+        self._lock.acquire()
+        timer = self.timers.setdefault(name, [0, 0.0])
+        timer[0] += 1
+        timer[1] += seconds
+        self._lock.release()
+
+    def count(self, name, value=1):
+        self._lock.acquire()
+        self.counters[name] = self.counters.get(name, 0) + value
+        self._lock.release()
+
+    def summary(self):
+        return {
+            'timers': dict(
+                (name, {'calls': calls, 'seconds': seconds})
+                for name, (calls, seconds) in self.timers.items()),
+            'counters': dict(self.counters),
+            }
+
+
+class _NoStats(object):
+    "Stands in for _Stats when instrumentation is off."
+
+    def time(self, name, func, *args):
+        return func(*args)
+
+    def add_time(self, name, seconds):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+_no_stats = _NoStats()
+
+
+def instrumentation_hook(func):
+    """Helper function to register instrumentation hooks.
+
+    Hooks are called with the recipe and the summary of its instrumentation
+    at the end of each install and update.
+    """
+    FileTemplate.instrumentation_hooks[func.__name__.replace('_', '-')] = func
+    return func
+
+@instrumentation_hook
+def json_summary(recipe, summary):
+    """Write the summary as JSON to <part name>.stats.json in the parts.
+
+    The file is installed with the part, so it is removed with it.
+    """
+    path = os.path.join(
+        recipe.buildout['buildout']['parts-directory'],
+        recipe.name + '.stats.json')
+    f = open(path, 'w')
+    try:
+        json.dump(summary, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+    recipe.options.created(path)
+
+@instrumentation_hook
+def log_summary(recipe, summary):
+    "Log the summary at the info level, slowest timers first."
+    timers = sorted(summary['timers'].items(),
+                    key=lambda item: -item[1]['seconds'])
+    for name, timer in timers:
+        recipe.logger.info(
+            '%s: %d calls, %.3f seconds.', name, timer['calls'],
+            timer['seconds'])
+    for name, value in sorted(summary['counters'].items()):
+        recipe.logger.info('%s: %d.', name, value)
+
+
+############################################################################
+# Writing
+class _Writer(object):
+    """Writes files atomically, leaving those with unchanged content alone.
+
+    ``add`` writes the content to a temporary file in the destination's
+    directory; ``commit`` renames the temporary files into place, directory
+    by directory, and ``abort`` removes those that were not committed.  With
+    ``fsync``, each file is synced before it is renamed, and each directory
+    is synced once after all of its files are in place.
+    """
+
+    def __init__(self, fsync=False):
+        self.fsync = fsync
+        self.pending = {} # directory -> [(temporary path, destination)]
+        self.written = self.unchanged = self.bytes_written = 0
+        self.copied = 0
+        self._lock = threading.Lock()
+
+    def add(self, dest, data, mode):
+        "Stage ``data`` for ``dest``.  Return False if it is unchanged."
+        if _same_content(dest, data):
+            self._keep(dest, mode)
+            return False
+        temp = self._write(dest, lambda write: write(data), mode)
+        self._stage(temp, dest, len(data))
+        return True
+
+    def add_stream(self, dest, render, mode):
+        """Stage the output of ``render(write)`` for ``dest``.
+
+        Return the size and digest of the output.
+        """
+        digest = hashlib.md5()
+        size = [0]
+        def render_to_file(file_write):
+            def write(data):
+                digest.update(data)
+                size[0] += len(data)
+                file_write(data)
+            render(write)
+        temp = self._write(dest, render_to_file, mode)
+        if _same_file(dest, temp):
+            os.remove(temp)
+            self._keep(dest, mode)
+        else:
+            self._stage(temp, dest, size[0])
+        return [size[0], digest.hexdigest()]
+
+    def add_copy(self, dest, source, mode, link=False):
+        """Stage a copy of ``source`` for ``dest``.
+
+        With ``link``, a hard link is made instead, where possible.  Return
+        False if the content is unchanged.
+        """
+        if _same_file(dest, source):
+            self._keep(dest, mode)
+            return False
+        directory, name = os.path.split(dest)
+        fd, temp = tempfile.mkstemp(prefix='.%s.' % name, dir=directory)
+        os.close(fd)
+        try:
+            linked = False
+            if link and hasattr(os, 'link'):
+                os.remove(temp)
+                try:
+                    os.link(source, temp)
+                    linked = True
+                except OSError: # E.g., another file system.
+                    pass
+            if not linked:
+                shutil.copyfile(source, temp)
+                if self.fsync:
+                    f = open(temp, 'a')
+                    try:
+                        os.fsync(f.fileno())
+                    finally:
+                        f.close()
+                os.chmod(temp, mode)
+        except:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        self._lock.acquire()
+        self.copied += 1
+        self._lock.release()
+        self._stage(temp, dest, os.path.getsize(temp))
+        return True
+
+    def _write(self, dest, render, mode):
+        "Write a temporary file for ``dest``, and return its path."
+        directory, name = os.path.split(dest)
+        fd, temp = tempfile.mkstemp(prefix='.%s.' % name, dir=directory)
+        try:
+            f = os.fdopen(fd, 'w')
+            try:
+                render(f.write)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            finally:
+                f.close()
+            os.chmod(temp, mode)
+        except:
+            os.remove(temp)
+            raise
+        return temp
+
+    def _keep(self, dest, mode):
+        if stat.S_IMODE(os.stat(dest).st_mode) != mode:
+            os.chmod(dest, mode)
+        self._lock.acquire()
+        self.unchanged += 1
+        self._lock.release()
+
+    def _stage(self, temp, dest, size):
+        self._lock.acquire()
+        self.pending.setdefault(os.path.dirname(dest), []).append(
+            (temp, dest))
+        self.bytes_written += size
+        self._lock.release()
+
+    def commit(self):
+        for directory in sorted(self.pending):
+            files = self.pending.pop(directory)
+            while files:
+                temp, dest = files.pop(0)
+                if os.name == 'nt' and os.path.exists(dest):
+                    os.remove(dest) # Windows cannot rename over a file.
+                os.rename(temp, dest)
+                self.written += 1
+            if self.fsync and hasattr(os, 'O_DIRECTORY'):
+                fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+    def abort(self):
+        for files in self.pending.values():
+            for temp, dest in files:
+                if os.path.exists(temp):
+                    os.remove(temp)
+        self.pending = {}
+
+
+def _same_file(path, other):
+    "Does the file at ``path`` exist and have the same content as ``other``?"
+    if not os.path.isfile(path):
+        return False
+    return filecmp.cmp(path, other, shallow=False)
+
+def _same_content(path, data):
+    "Does the file at ``path`` exist and contain ``data``?"
+    try:
+        statinfo = os.stat(path)
+    except OSError:
+        return False
+    if not stat.S_ISREG(statinfo.st_mode) or statinfo.st_size != len(data):
+        return False
+    f = open(path)
+    try:
+        return f.read() == data
+    finally:
+        f.close()
+
+
+def _call_safely(func, *args):
+    "Call ``func``, returning rather than raising the exception it raises."
+    try:
+        return func(*args)
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except Exception:
+        return sys.exc_info()[1]
+
+def _raise_first_error(results):
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+############################################################################
+# Render cache
+class _RenderCache(object):
+    """Rendered outputs in a directory, by the key of their inputs.
+
+    The directory may be shared by several buildouts.  Entries are written
+    atomically, and their modification time is updated when they are used,
+    so that ``evict`` removes the least recently used ones when the cache
+    holds more than ``size`` bytes (0 means no limit).
+    """
+
+    def __init__(self, directory, size):
+        self.directory = directory
+        self.size = size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def get(self, key):
+        "Return the output for ``key``, or None."
+        path = self._path(key)
+        try:
+            f = open(path)
+        except IOError:
+            return None
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass # Evicted meanwhile.
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        fd, temp = tempfile.mkstemp(prefix='.tmp', dir=directory)
+        try:
+            f = os.fdopen(fd, 'w')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(temp, path)
+        except (IOError, OSError):
+            # E.g., on Windows, another buildout stored the entry first.  The
+            # cache is only an optimization, so errors are not fatal.
+            if os.path.exists(temp):
+                os.remove(temp)
+
+    def evict(self):
+        "Remove the least recently used entries beyond the size limit."
+        if not self.size or not os.path.isdir(self.directory):
+            return
+        entries = []
+        total = 0
+        for prefix in os.listdir(self.directory):
+            directory = os.path.join(self.directory, prefix)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    statinfo = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((statinfo.st_mtime, path, statinfo.st_size))
+                total += statinfo.st_size
+        entries.sort()
+        for mtime, path, size in entries:
+            if total <= self.size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass # Another buildout evicted it.
+            total -= size
+
+
+############################################################################
+# Shared engine
+class _Engine(object):
+    """Work shared by the parts of a buildout that set ``shared-engine``.
+
+    Each directory is listed once for all of these parts, and their compiled
+    templates are shared, as always, through _compiled.  At the first
+    install of one of them, ``render`` renders the templates of all those
+    about to be installed in one batch; each part then writes its files, and
+    records them, when buildout installs it.
+    """
+
+    def __init__(self):
+        self.recipes = {} # part name -> recipe
+        self.rendered = False
+        self._scans = {}
+
+    def scan(self, directory):
+        "Return _scan(directory), listing each directory once."
+        try:
+            return self._scans[directory]
+        except KeyError:
+            result = self._scans[directory] = _scan(directory)
+            return result
+
+    def render(self):
+        """Render the templates of the parts about to be installed, once.
+
+        Parts are about to be installed when none of their destinations
+        exist, as buildout uninstalls parts before installing any.  Results,
+        or the exceptions raised, are kept in the ``_prerendered`` dict of
+        each recipe, which uses them unless the template changed since.
+        """
+        if self.rendered:
+            return
+        self.rendered = True
+        work = []
+        for name in sorted(self.recipes):
+            recipe = self.recipes[name]
+            if not [rel_path for rel_path, last_mod, st_mode in recipe.actions
+                    if os.path.exists(
+                        os.path.join(recipe.destination_dir, rel_path[:-3]))]:
+                work.extend(
+                    (recipe, rel_path)
+                    for rel_path, last_mod, st_mode in recipe.actions)
+        if not work:
+            return
+        threads = max(part.parallel for part, rel_path in work)
+        if threads == 1:
+            results = [_prerender(part, rel_path) for part, rel_path in work]
+        else:
+            pool = ThreadPool(min(threads, len(work)))
+            try:
+                results = pool.map(lambda item: _prerender(*item), work)
+            finally:
+                pool.close()
+                pool.join()
+        for (part, rel_path), result in zip(work, results):
+            part._prerendered[rel_path] = result
+        logging.getLogger('z3c.recipe.filetemplate').debug(
+            'Rendered %d templates of %d parts in one batch.',
+            len(work), len(set(part.name for part, rel_path in work)))
+
+
+def _engine(buildout):
+    "Return the engine shared by the parts of ``buildout``."
+    engine = getattr(buildout, ENGINE_ATTRIBUTE, None)
+    if engine is None:
+        engine = _Engine()
+        setattr(buildout, ENGINE_ATTRIBUTE, engine)
+    return engine
+
+def _prerender(recipe, rel_path):
+    "Render a template for _Engine.render.  Return its mtime and result."
+    mtime = _mtime(os.path.join(recipe.source_dir, rel_path))
+    return mtime, _call_safely(recipe._render, rel_path)
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+############################################################################
+# Discovery
+def _translate(pattern):
+    "Return the regular expression for a glob, without trailing flags."
+    regex = fnmatch.translate(pattern)
+    if regex.endswith('(?ms)'): # Python 2 appends the flags.
+        regex = regex[:-5]
+    return regex
+
+_CASE_FLAGS = re.S
+if os.path.normcase('A') != 'A':
+    _CASE_FLAGS |= re.I
+
+
+class _FileMatcher(object):
+    """The ``files`` patterns of a part, compiled and grouped by directory.
+
+    Patterns without a directory apply everywhere.  Others only apply to the
+    directory they name, which must match precisely; '.' is the source
+    directory itself.
+    """
+
+    def __init__(self, patterns):
+        self.everywhere = []
+        self.by_directory = {}
+        for orig_pattern in patterns:
+            parts = orig_pattern.split('/')
+            dir = os.path.sep.join(parts[:-1])
+            pattern = (orig_pattern, _translate(parts[-1]))
+            if not dir:
+                self.everywhere.append(pattern)
+            else:
+                if dir == '.':
+                    dir = ''
+                self.by_directory.setdefault(dir, []).append(pattern)
+        self._compiled = {}
+
+    def directories(self):
+        """Return the directories that patterns apply to, in walking order.
+
+        Return None if some patterns apply everywhere.
+        """
+        if self.everywhere:
+            return None
+        return sorted(self.by_directory,
+                      key=lambda dir: dir.split(os.path.sep))
+
+    def literal_names(self, relative_prefix):
+        """Return the names the patterns of a directory match, or None.
+
+        None is returned unless all the patterns that apply to the directory
+        are file names, without wildcards.
+        """
+        names = []
+        for orig_pattern, regex in (
+            self.everywhere + self.by_directory.get(relative_prefix, [])):
+            name = orig_pattern.split('/')[-1]
+            if '*' in name or '?' in name or '[' in name:
+                return None
+            names.append(name)
+        return names
+
+    def _get(self, relative_prefix):
+        if relative_prefix not in self.by_directory:
+            relative_prefix = None
+        try:
+            return self._compiled[relative_prefix]
+        except KeyError:
+            pass
+        patterns = self.everywhere + self.by_directory.get(relative_prefix, [])
+        if patterns:
+            combined = re.compile(
+                '|'.join('(?:%s)' % regex for orig, regex in patterns),
+                _CASE_FLAGS)
+            patterns = [(orig, re.compile(regex, _CASE_FLAGS))
+                        for orig, regex in patterns]
+        else:
+            combined = None
+        result = self._compiled[relative_prefix] = combined, patterns
+        return result
+
+    def match(self, relative_prefix, names, unmatched):
+        """Return the sorted names in a directory that match any pattern.
+
+        Patterns that match are discarded from the ``unmatched`` set.
+        """
+        combined, patterns = self._get(relative_prefix)
+        if combined is None:
+            return []
+        found = sorted(name for name in names if combined.match(name))
+        if found and unmatched:
+            for orig_pattern, regex in patterns:
+                if orig_pattern in unmatched:
+                    for name in found:
+                        if regex.match(name):
+                            unmatched.discard(orig_pattern)
+                            break
+        return found
+
+
+def _excluder(exclude_dirs):
+    """Return a predicate for relative directory paths to leave out.
+
+    Each entry of ``exclude_dirs`` is either a precise relative path or a
+    glob matched against the whole relative path.
+    """
+    literal = set()
+    globs = []
+    for dir in exclude_dirs:
+        if '*' in dir or '?' in dir or '[' in dir:
+            globs.append(_translate(dir))
+        else:
+            literal.add(dir)
+    if globs:
+        regex = re.compile('|'.join('(?:%s)' % g for g in globs), _CASE_FLAGS)
+        return lambda path: path in literal or regex.match(path) is not None
+    return literal.__contains__
+
+def _scan(directory):
+    """Return the regular files and subdirectories of ``directory``.
+
+    Files are returned as a dict mapping names to functions that return
+    their stat results, so only the files we want are stat'ed.  Symbolic
+    links to files are followed, as with os.stat, but symbolic links to
+    directories are not returned, so that walks do not descend into them,
+    as with os.path.walk.
+    """
+    files = {}
+    dirs = []
+    if scandir is not None:
+        for entry in scandir(directory):
+            try:
+                if entry.is_file():
+                    files[entry.name] = entry.stat
+                elif entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.name)
+            except OSError:
+                pass # E.g., a broken symbolic link.
+    else:
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                statinfo = os.stat(path)
+            except OSError:
+                continue
+            if stat.S_ISREG(statinfo.st_mode):
+                files[name] = lambda statinfo=statinfo: statinfo
+            elif stat.S_ISDIR(statinfo.st_mode) and not os.path.islink(path):
+                dirs.append(name)
+    return files, dirs
+
+def _stat_files(directory, names):
+    "Return the regular files of ``names`` in ``directory``, like _scan."
+    files = {}
+    for name in names:
+        try:
+            statinfo = os.stat(os.path.join(directory, name))
+        except OSError:
+            continue
+        if stat.S_ISREG(statinfo.st_mode):
+            files[name] = lambda statinfo=statinfo: statinfo
+    return files
+
+def _under_excluded(relative_prefix, excluded):
+    "Is the directory, or one of its parents, left out by ``excluded``?"
+    if not relative_prefix:
+        return False # The source directory itself is never left out.
+    parts = relative_prefix.split(os.path.sep)
+    for i in range(len(parts)):
+        if excluded(os.path.sep.join(parts[:i + 1])):
+            return True
+    return False
+
+def _discover(top, matcher, excluded, scan=_scan):
+    """Yield (relative directory, files) for directories ``matcher`` uses.
+
+    When every pattern names its directory, only those directories are
+    visited, in the order of _walk, and the files of those whose patterns
+    are all file names are stat'ed without listing the directory.
+    Otherwise, this is _walk.
+    """
+    directories = matcher.directories()
+    if directories is None:
+        for result in _walk(top, excluded, scan):
+            yield result
+        return
+    for relative_prefix in directories:
+        if _under_excluded(relative_prefix, excluded):
+            continue
+        directory = os.path.join(top, relative_prefix)
+        names = matcher.literal_names(relative_prefix)
+        if names is not None:
+            files = _stat_files(directory, names)
+        else:
+            try:
+                files = scan(directory)[0]
+            except OSError:
+                continue # The directory does not exist.
+        yield relative_prefix, files
+
+def _walk(top, excluded, scan=_scan):
+    """Yield (relative directory, files) for ``top`` and its subdirectories.
+
+    Directories for which ``excluded`` returns true are neither listed nor
+    descended into.  Directories are visited top-down, in sorted order.
+    Directories are listed with ``scan``, which works like _scan.  As with
+    os.path.walk, directories that cannot be listed are skipped.
+    """
+    pending = ['']
+    while pending:
+        relative_prefix = pending.pop()
+        try:
+            files, dirs = scan(os.path.join(top, relative_prefix))
+        except OSError:
+            continue
+        yield relative_prefix, files
+        subdirs = []
+        for name in dirs:
+            path = os.path.join(relative_prefix, name)
+            if not excluded(path):
+                subdirs.append(path)
+        subdirs.sort(reverse=True)
+        pending.extend(subdirs)
 
 
 ############################################################################
 # Filters
+# Composed filter chains, by the filter text of placeholders, like
+# '|upper|path-repr'.
+_pipelines = {}
+
+def _pipeline(text, filters):
+    """Return a function applying the filters in ``text`` to a value.
+
+    Filters are looked up in ``filters``, or loaded from entry points.
+    Raise LookupError with the name of the first unknown filter.
+    """
+    pipeline = _pipelines.get(text)
+    if pipeline is not None:
+        return pipeline
+    chain = []
+    for name in text.split('|')[1:]:
+        name = name.strip()
+        func = _registered(filters, FILTERS_GROUP, name)
+        if func is None:
+            raise LookupError(name)
+        chain.append((name, func, 'filter:%s' % name))
+    def pipeline(val, template, start):
+        stats = template.recipe.stats
+        for name, func, timer in chain:
+            try:
+                val = stats.time(timer, func, val, template, start, name)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                colno, lineno = template.get_colno_lineno(start)
+                template.recipe.logger.error(
+                    'Filter %r in line %d, col %d of %s '
+                    'crashed processing value %r', name, lineno, colno,
+                    template.source, val, exc_info=True)
+                raise
+        return val
+    _pipelines[text] = pipeline
+    return pipeline
+
+# Names looked up in vain in entry point groups, as (group, name).
+_unregistered = set()
+
+def _registered(registry, group, name):
+    """Return the function registered as ``name``, or None.
+
+    Functions missing from ``registry`` are loaded from the entry point
+    named ``name`` in ``group``, if any, and added to it.
+    """
+    func = registry.get(name)
+    if func is None and (group, name) not in _unregistered:
+        for entry_point in pkg_resources.iter_entry_points(group, name):
+            func = registry[name] = entry_point.load()
+            break
+        else:
+            _unregistered.add((group, name))
+    return func
+
 def filter(func):
     "Helper function to register filter functions."
     FileTemplate.filters[func.__name__.replace('_', '-')] = func
@@ -404,20 +2260,127 @@ def shell_path(val, template, start, filter):
         lambda p: '"$Z3C_RECIPE_FILETEMPLATE_BASE"/%s' % (p,),
         lambda p: p)
 
+# Serializers render lists and mappings, like those of the path-list
+# dynamic option, as text.  Text values are taken as lists of lines.
+def json_filter(val, template, start, filter):
+    return _serialized(val, template, filter, _format_json)
+# Registered by hand, as a function named json would hide the module.
+FileTemplate.filters['json'] = json_filter
+
+@filter
+def python_list(val, template, start, filter):
+    return _serialized(val, template, filter, _format_python_list)
+
+@filter
+def shell_quote_list(val, template, start, filter):
+    return _serialized(val, template, filter, _format_shell_quote_list)
+
+@filter
+def ini_escape(val, template, start, filter):
+    return _serialized(val, template, filter, _format_ini)
+
+def _serialized(val, template, filter, format):
+    """Return ``format(val, template)``.
+
+    Results for lists and mappings are memoized by the recipe for each value
+    and destination directory, which relative paths depend on, so that a
+    value used in many places is only formatted once for each directory.
+    """
+    if isinstance(val, basestring):
+        return format(val, template)
+    cache = template.recipe._serialized
+    key = (filter, id(val), os.path.dirname(template.destination))
+    cached = cache.get(key)
+    if cached is not None and cached[0] is val:
+        return cached[1]
+    result = format(val, template)
+    # The value is kept, so that its id is not reused.
+    cache[key] = (val, result)
+    return result
+
+def _items(val):
+    "Return the items of a list, or the lines of a text value."
+    if isinstance(val, basestring):
+        return [line.strip() for line in val.splitlines() if line.strip()]
+    if isinstance(val, dict):
+        raise TypeError('A mapping is not a list.')
+    return list(val)
+
+def _format_json(val, template):
+    if isinstance(val, (basestring, _PathList)):
+        val = _items(val)
+    return json.dumps(val, sort_keys=True)
+
+def _format_python_list(val, template):
+    if isinstance(val, _PathList):
+        return '[%s]' % ', '.join(
+            _maybe_relativize(
+                path, template,
+                lambda p: "_z3c_recipe_filetemplate_path_repr(%r)" % (p,),
+                repr)
+            for path in val)
+    return repr(_items(val))
+
+def _format_shell_quote_list(val, template):
+    if isinstance(val, _PathList):
+        return ' '.join(
+            _maybe_relativize(
+                path, template,
+                lambda p: '"$Z3C_RECIPE_FILETEMPLATE_BASE"/%s' % (
+                    _shell_quote(p),),
+                _shell_quote)
+            for path in val)
+    return ' '.join(_shell_quote(item) for item in _items(val))
+
+def _format_ini(val, template):
+    # Lines after the first are indented, so that they continue the value,
+    # and percent signs are doubled, so that they are not interpolated.
+    if isinstance(val, basestring):
+        lines = [line for line in val.splitlines() if line.strip()]
+    else:
+        lines = _items(val)
+    return '\n    '.join(lines).replace('%', '%%')
+
 # Helpers hacked from zc.buildout.easy_install.
 def _maybe_relativize(path, template, relativize, absolutize):
-    path = zc.buildout.easy_install.realpath(path)
-    if template.recipe.relative_paths:
-        buildout_root = template.recipe.buildout_root
-        if path == buildout_root:
-            return relativize(os.curdir)
-        destination = template.destination
-        common = os.path.dirname(os.path.commonprefix([path, destination]))
-        if (common == buildout_root or
-            common.startswith(os.path.join(buildout_root, ''))
-            ):
-            return relativize(_relative_path(common, path))
-    return absolutize(path)
+    path, relative = _relativized(path, template)
+    if relative is None:
+        return absolutize(path)
+    return relativize(relative)
+
+def _relativized(path, template):
+    """Return the real path of ``path`` and its buildout-relative version.
+
+    The relative version is None if the path should stay absolute.  The
+    result only depends on the directory of the destination, so it is
+    memoized by the recipe for each path and directory.
+    """
+    recipe = template.recipe
+    destination = template.destination
+    key = (path, os.path.dirname(destination))
+    try:
+        return recipe._relativized[key]
+    except KeyError:
+        pass
+    try:
+        real = recipe._realpaths[path]
+    except KeyError:
+        real = recipe._realpaths[path] = zc.buildout.easy_install.realpath(
+            path)
+    relative = None
+    if recipe.relative_paths:
+        buildout_root = recipe.buildout_root
+        if real == buildout_root:
+            relative = os.curdir
+        else:
+            common = os.path.dirname(
+                os.path.commonprefix([real, destination]))
+            if (common == buildout_root or
+                common.startswith(os.path.join(buildout_root, ''))
+                ):
+                relative = _relative_path(common, real)
+    result = recipe._relativized[key] = real, relative
+    return result
 
 def _relative_path(common, path):
     """Return the relative path from ``common`` to ``path``.
@@ -446,23 +2409,55 @@ def dynamic_option(func):
 
 @dynamic_option
 def os_paths(template, start, name):
-    return os.pathsep.join(
-        shell_path(path, template, start, 'os-paths')
-        for path in template.recipe.paths)
+    return _join_paths(template, start, name, shell_path, os.pathsep)
 
 @dynamic_option
 def string_paths(template, start, name):
     colno, lineno = template.get_colno_lineno(start)
     separator = ',\n' + ((colno - 1) * ' ')
-    return separator.join(
-        path_repr(path, template, start, 'string-paths')
-        for path in template.recipe.paths)
+    return _join_paths(template, start, name, path_repr, separator)
 
 @dynamic_option
 def space_paths(template, start, name):
-    return ' '.join(
-        shell_path(path, template, start, 'space-paths')
+    return _join_paths(template, start, name, shell_path, ' ')
+
+@dynamic_option
+def path_list(template, start, name):
+    """Return the real paths of the recipe, as a list.
+
+    Render it with a serializer filter, like python-list or json.
+    """
+    cache = template.recipe._path_lists
+    key = (name,)
+    try:
+        return cache[key]
+    except KeyError:
+        pass
+    result = cache[key] = _PathList(
+        _relativized(path, template)[0] for path in template.recipe.paths)
+    return result
+
+class _PathList(list):
+    """The paths of a recipe.
+
+    Serializers relativize them, if the recipe uses relative paths.
+    """
+
+def _join_paths(template, start, name, filter, separator):
+    """Return the recipe's paths, filtered and joined by ``separator``.
+
+    The result is memoized by the recipe for each destination directory.
+    """
+    cache = template.recipe._path_lists
+    key = (name, os.path.dirname(template.destination), separator)
+    try:
+        return cache[key]
+    except KeyError:
+        pass
+    result = cache[key] = separator.join(
+        filter(path, template, start, name)
         for path in template.recipe.paths)
+    return result
 
 @dynamic_option
 def shell_relative_path_setup(template, start, name):
@@ -470,6 +2465,9 @@ def shell_relative_path_setup(template, start, name):
         depth = _relative_depth(
             template.recipe.buildout['buildout']['directory'],
             template.destination)
+        if template.recipe.relative_path_setup == 'precomputed':
+            # Strip the file name and ``depth`` directories at once.
+            return SHELL_PRECOMPUTED_PATH_SETUP % ('/*' * (depth + 1),)
         value = SHELL_RELATIVE_PATH_SETUP
         if depth:
             value += '# Ascend to buildout root.\n'
@@ -494,12 +2492,27 @@ SHELL_DIRNAME = '''\
 Z3C_RECIPE_FILETEMPLATE_BASE=`dirname ${Z3C_RECIPE_FILETEMPLATE_BASE}`
 '''
 
+# With ``relative-path-setup = precomputed``, one readlink call finds the
+# file, and shell parameter expansion finds the buildout root.
+SHELL_PRECOMPUTED_PATH_SETUP = '''\
+# Get full, non-symbolic-link path to this file.
+Z3C_RECIPE_FILETEMPLATE_FILENAME=`\\
+    readlink -f "$0" 2>/dev/null || \\
+    realpath "$0" 2>/dev/null || \\
+    type -P "$0" 2>/dev/null`
+# Ascend to buildout root.
+Z3C_RECIPE_FILETEMPLATE_BASE=${Z3C_RECIPE_FILETEMPLATE_FILENAME%%%s}
+'''
+
 @dynamic_option
 def python_relative_path_setup(template, start, name):
     if template.recipe.relative_paths:
         depth = _relative_depth(
             template.recipe.buildout['buildout']['directory'],
             template.destination)
+        if template.recipe.relative_path_setup == 'precomputed':
+            return PYTHON_PRECOMPUTED_PATH_SETUP % (
+                os.path.join(*[os.pardir] * (depth + 1)),)
         value = PYTHON_RELATIVE_PATH_SETUP_START
         if depth:
             value += '# Ascend to buildout root.\n'
@@ -536,6 +2549,21 @@ def _z3c_recipe_filetemplate_path_repr(path):
     return os.path.join(_z3c_recipe_filetemplate_base, path)
 '''
 
+# With ``relative-path-setup = precomputed``, the path of the file is the
+# one recorded when it was run or imported, and one realpath call and a
+# join with a precomputed relative path find the buildout root.
+PYTHON_PRECOMPUTED_PATH_SETUP = '''\
+import os
+# Get the full, non-symbolic-link path to this file.  For compiled modules,
+# we want the location of the .py file, because it may have been symlinked.
+_z3c_recipe_filetemplate_filename = __file__
+if _z3c_recipe_filetemplate_filename[-4:] in ('.pyc', '.pyo'):
+    _z3c_recipe_filetemplate_filename = _z3c_recipe_filetemplate_filename[:-1]
+# Ascend to buildout root.
+_z3c_recipe_filetemplate_base = os.path.normpath(os.path.join(
+    os.path.realpath(_z3c_recipe_filetemplate_filename), %r))
+''' + PYTHON_RELATIVE_PATH_SETUP_END
+
 def _relative_depth(common, path):
     # Helper ripped from zc.buildout.easy_install.
     """Return number of dirs separating ``path`` from ancestor, ``common``.
@@ -0,0 +1,330 @@
+##############################################################################
+#
+# Copyright (c) 2007-2009 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Benchmarks for template discovery, rendering and install.
+
+Each scenario generates a synthetic buildout in a temporary directory, and
+measures three phases of the recipe:
+
+``discovery``
+  Setting up the recipe, which finds the templates.
+
+``render``
+  Rendering every template, without writing anything.
+
+``install``
+  Installing the part, which renders and writes every file.
+
+For each phase, the wall time and the number of calls to the main file
+system functions are reported, with the peak resident memory of the process
+so far, in kilobytes, where the resource module is available.  The phases
+run in one process, so that peak only grows from one phase to the next.
+Results may be saved as a baseline, and compared with a baseline to find
+regressions.
+"""
+
+import json
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import zc.buildout.buildout
+import z3c.recipe.filetemplate
+
+
+class Scenario(object):
+    """The shape of a synthetic buildout."""
+
+    def __init__(self, name, files=10, depth=1, density=5, filters=0,
+                 paths=5):
+        self.name = name
+        self.files = files      # Number of templates.
+        self.depth = depth      # Depth of the directories holding them.
+        self.density = density  # Placeholders in each template.
+        self.filters = filters  # Length of the filter chain of placeholders.
+        self.paths = paths      # Size of the working set, as extra paths.
+
+    def __repr__(self):
+        return ('<Scenario %s: files=%d depth=%d density=%d filters=%d '
+                'paths=%d>' % (self.name, self.files, self.depth,
+                               self.density, self.filters, self.paths))
+
+
+SCENARIOS = [
+    Scenario('small'),
+    Scenario('many-files', files=2000),
+    Scenario('deep', files=500, depth=8),
+    Scenario('dense', files=50, density=2000),
+    Scenario('filters', files=50, density=500, filters=3),
+    Scenario('paths', files=50, paths=500),
+    ]
+
+PHASES = ('discovery', 'render', 'install')
+
+# Functions whose calls are counted, as (module, name).
+COUNTED = [(os, name) for name in (
+    'stat', 'lstat', 'listdir', 'scandir', 'open', 'rename', 'mkdir',
+    'remove', 'fsync', 'chmod')]
+COUNTED.append((builtins, 'open'))
+COUNTED.append((z3c.recipe.filetemplate, 'scandir'))
+
+FILTERS = ('upper', 'lower', 'capitalize', 'title')
+
+
+def generate(directory, scenario):
+    """Write the buildout of the scenario in the directory.
+
+    The templates are in the ``bench`` section, which has no recipe, so that
+    buildout does not need to load one.  Return the path of the
+    configuration file.
+    """
+    os.mkdir(os.path.join(directory, 'parts'))
+    for i in range(scenario.paths):
+        os.makedirs(os.path.join(directory, 'lib', 'path%d' % i))
+    source = os.path.join(directory, 'templates')
+    for i in range(scenario.files):
+        parts = ['d%d' % ((i + level) % 3) for level in range(scenario.depth)]
+        parent = os.path.join(source, *parts[:-1])
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        f = open(os.path.join(parent, 'file%d.txt.in' % i), 'w')
+        try:
+            f.write(_template(scenario))
+        finally:
+            f.close()
+    config = os.path.join(directory, 'buildout.cfg')
+    f = open(config, 'w')
+    try:
+        f.write(
+            '[buildout]\n'
+            'parts =\n'
+            '\n'
+            '[config]\n'
+            'value = a value from another section\n'
+            '\n'
+            '[bench]\n'
+            'source-directory = templates\n'
+            'world = a value\n'
+            'extra-paths =\n')
+        for i in range(scenario.paths):
+            f.write('    lib/path%d\n' % i)
+    finally:
+        f.close()
+    return config
+
+
+def _template(scenario):
+    chain = ''.join(
+        '|%s' % FILTERS[i % len(FILTERS)] for i in range(scenario.filters))
+    placeholders = [
+        '${world%s}' % chain,
+        '${config:value%s}' % chain,
+        '${bench:world}',
+        ]
+    lines = ['# A synthetic template.\n']
+    if scenario.paths:
+        lines.append('paths = [\n    ${string-paths}]\n')
+    for i in range(scenario.density):
+        lines.append('line %d: %s, $${escaped}\n' % (
+            i, placeholders[i % len(placeholders)]))
+    return ''.join(lines)
+
+
+class CallCounter(object):
+    """Count the calls to the functions in COUNTED while it is active."""
+
+    def __init__(self):
+        self.counts = {}
+        self._originals = []
+
+    def start(self):
+        for module, name in COUNTED:
+            original = getattr(module, name, None)
+            if original is None:
+                continue
+            self._originals.append((module, name, original))
+            setattr(module, name, self._wrap(name, original))
+
+    def stop(self):
+        while self._originals:
+            module, name, original = self._originals.pop()
+            setattr(module, name, original)
+
+    def _wrap(self, name, original):
+        counts = self.counts
+        def counted(*args, **kw):
+            counts[name] = counts.get(name, 0) + 1
+            return original(*args, **kw)
+        return counted
+
+
+def measure(func):
+    """Call func, and return its result and the measurements of the call.
+    """
+    counter = CallCounter()
+    counter.start()
+    started = time.time()
+    try:
+        result = func()
+    finally:
+        elapsed = time.time() - started
+        counter.stop()
+    if resource is not None:
+        # The peak of the whole process so far, not of this call alone.
+        memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    else:
+        memory = None
+    return result, {'time': elapsed, 'calls': counter.counts,
+                    'memory': memory}
+
+
+def _clear_caches():
+    z3c.recipe.filetemplate._compiled_templates.clear()
+    z3c.recipe.filetemplate._working_set_paths.clear()
+
+
+def run(scenario, repeat=3):
+    """Run the scenario, and return the measurements of each phase.
+
+    The best time of the runs is kept.
+    """
+    results = {}
+    here = os.getcwd()
+    for i in range(repeat):
+        directory = tempfile.mkdtemp(prefix='filetemplate-benchmark-')
+        try:
+            config = generate(directory, scenario)
+            buildout = zc.buildout.buildout.Buildout(
+                config, [('buildout', 'offline', 'true')],
+                user_defaults=False)
+            _clear_caches()
+            measured = {}
+            recipe, measured['discovery'] = measure(
+                lambda: z3c.recipe.filetemplate.FileTemplate(
+                    buildout, 'bench', buildout['bench']))
+            _clear_caches()
+            ignored, measured['render'] = measure(
+                lambda: [recipe._render(action[0])
+                         for action in recipe.actions])
+            _clear_caches()
+            # Install the way buildout does, so that files can be created.
+            ignored, measured['install'] = measure(
+                lambda: buildout['bench']._call(recipe.install))
+        finally:
+            os.chdir(here) # Buildout changes to its directory.
+            shutil.rmtree(directory)
+        for phase, values in measured.items():
+            best = results.get(phase)
+            if best is None or values['time'] < best['time']:
+                results[phase] = values
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return descriptions of the regressions of results from baseline.
+
+    A phase regresses when it is slower than the baseline by more than the
+    tolerance, as a fraction, or when it makes more calls.
+    """
+    regressions = []
+    for name in sorted(results):
+        for phase in PHASES:
+            old = baseline.get(name, {}).get(phase)
+            new = results[name].get(phase)
+            if old is None or new is None:
+                continue
+            if new['time'] > old['time'] * (1 + tolerance):
+                regressions.append(
+                    '%s %s: %.3fs, was %.3fs' % (
+                        name, phase, new['time'], old['time']))
+            for function, count in sorted(new['calls'].items()):
+                if count > old['calls'].get(function, 0):
+                    regressions.append(
+                        '%s %s: %d calls to %s, was %d' % (
+                            name, phase, count, function,
+                            old['calls'].get(function, 0)))
+    return regressions
+
+
+def report(results, out=None):
+    """Write a table of the results."""
+    if out is None:
+        out = sys.stdout
+    out.write('%-12s %-10s %10s %10s %12s\n' % (
+        'scenario', 'phase', 'seconds', 'calls', 'process peak'))
+    for name in sorted(results):
+        for phase in PHASES:
+            values = results[name][phase]
+            out.write('%-12s %-10s %10.4f %10d %12s\n' % (
+                name, phase, values['time'],
+                sum(values['calls'].values()), values['memory']))
+
+
+def main(args=None):
+    parser = optparse.OptionParser(
+        usage='%prog [options] [scenario ...]',
+        description='Benchmark z3c.recipe.filetemplate.  Scenarios: ' +
+        ', '.join(scenario.name for scenario in SCENARIOS) + '.')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='Runs of each scenario, of which the best is kept.')
+    parser.add_option('-s', '--save', metavar='FILE',
+                      help='Save the results as a baseline in FILE.')
+    parser.add_option('-c', '--compare', metavar='FILE',
+                      help='Compare the results with the baseline in FILE.')
+    parser.add_option('-t', '--tolerance', type='float', default=0.2,
+                      help='Slowdown, as a fraction, that is not a '
+                      'regression.  The default is 0.2.')
+    options, names = parser.parse_args(args)
+    scenarios = dict((scenario.name, scenario) for scenario in SCENARIOS)
+    for name in names:
+        if name not in scenarios:
+            parser.error('Unknown scenario: %s' % name)
+    results = {}
+    for name in names or [scenario.name for scenario in SCENARIOS]:
+        results[name] = run(scenarios[name], options.repeat)
+    report(results)
+    if options.save:
+        f = open(options.save, 'w')
+        try:
+            json.dump(results, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    if options.compare:
+        f = open(options.compare)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        regressions = compare(results, baseline, options.tolerance)
+        for regression in regressions:
+            sys.stdout.write('Regression: %s\n' % regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
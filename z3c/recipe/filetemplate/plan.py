@@ -0,0 +1,67 @@
+##############################################################################
+#
+# Copyright (c) 2007-2009 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Show what a buildout would do with its z3c.recipe.filetemplate parts.
+
+The buildout configuration is loaded, which sets up its parts and so finds
+their templates, and the plan of each part using this recipe is written as
+JSON.  Nothing is installed, rendered or written.  See FileTemplate.plan.
+"""
+
+import json
+import optparse
+import os
+import sys
+
+import zc.buildout.buildout
+import z3c.recipe.filetemplate
+
+
+def plans(config, parts=()):
+    """Return the plans of the parts of the buildout using this recipe.
+
+    Only ``parts`` are planned, if given.
+    """
+    here = os.getcwd()
+    try:
+        buildout = zc.buildout.buildout.Buildout(
+            config, [('buildout', 'offline', 'true')])
+        if not parts:
+            parts = buildout['buildout']['parts'].split()
+        result = []
+        for name in parts:
+            recipe = getattr(buildout[name], 'recipe', None)
+            if isinstance(recipe, z3c.recipe.filetemplate.FileTemplate):
+                result.append(recipe.plan())
+    finally:
+        os.chdir(here) # Buildout changes to its directory.
+    return result
+
+
+def main(args=None):
+    parser = optparse.OptionParser(
+        usage='%prog [options] [part ...]',
+        description='Write, as JSON, what installing the parts of a buildout '
+        'that use z3c.recipe.filetemplate would do.')
+    parser.add_option('-c', '--config', default='buildout.cfg',
+                      help='The buildout configuration file.  The default is '
+                      'buildout.cfg.')
+    options, parts = parser.parse_args(args)
+    json.dump(plans(options.config, parts), sys.stdout, indent=2,
+              sort_keys=True)
+    sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
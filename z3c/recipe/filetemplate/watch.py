@@ -0,0 +1,318 @@
+##############################################################################
+#
+# Copyright (c) 2007-2009 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Keep the files of z3c.recipe.filetemplate parts up to date.
+
+The buildout configuration is loaded once, and its templates and
+configuration files are watched, with inotify if pyinotify is installed, or
+by polling otherwise.  When a template changes, only its file is rendered
+again.  When a configuration file changes, or templates are added or
+removed, the buildout is loaded again, and the files whose templates or
+values changed are rendered again.  See FileTemplate.refresh.
+
+This is meant for development: parts are not installed or uninstalled, so
+the files of new templates are not rendered, and buildout has to be run
+after adding templates or changing anything else than templates and values.
+"""
+
+import logging
+import optparse
+import os
+import sys
+import time
+
+try:
+    from ConfigParser import RawConfigParser, Error as ConfigError
+except ImportError:
+    from configparser import RawConfigParser, Error as ConfigError
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+import zc.buildout
+import zc.buildout.buildout
+import z3c.recipe.filetemplate
+
+logger = logging.getLogger('z3c.recipe.filetemplate.watch')
+
+
+class Session(object):
+    """A loaded buildout, and the parts of it that use this recipe."""
+
+    def __init__(self, config, parts=()):
+        self.config = os.path.abspath(config)
+        self.parts = parts
+        self.buildout = None
+        self.recipes = []
+        self.load()
+
+    def load(self):
+        "Load the buildout configuration, and set up its parts."
+        root = logging.getLogger()
+        handlers = (root.handlers[:],
+                    logging.getLogger('zc.buildout').handlers[:])
+        buildout = zc.buildout.buildout.Buildout(
+            self.config, [('buildout', 'offline', 'true')])
+        if self.buildout is not None:
+            # Buildout sets up logging each time it is loaded.
+            root.handlers[:] = handlers[0]
+            logging.getLogger('zc.buildout').handlers[:] = handlers[1]
+        parts = self.parts or buildout['buildout']['parts'].split()
+        recipes = []
+        for name in parts:
+            recipe = getattr(buildout[name], 'recipe', None)
+            if isinstance(recipe, z3c.recipe.filetemplate.FileTemplate):
+                recipes.append((name, recipe))
+        self.buildout = buildout
+        self.recipes = recipes
+
+    def configs(self):
+        "Return the paths of the configuration files of the buildout."
+        return _config_files(self.config)
+
+    def directories(self):
+        "Return the paths of the directories holding templates."
+        directories = set()
+        for name, recipe in self.recipes:
+            directories.add(recipe.source_dir)
+            for action in recipe.actions:
+                directories.add(os.path.dirname(
+                    os.path.join(recipe.source_dir, action[0])))
+        return directories
+
+    def sources(self):
+        "Return the paths of the templates."
+        return set(os.path.join(recipe.source_dir, action[0])
+                   for name, recipe in self.recipes
+                   for action in recipe.actions)
+
+    def paths(self):
+        "Return the paths to watch."
+        return self.configs() | self.directories() | self.sources()
+
+    def refresh(self, changed=None):
+        """Render the files that are out of date after ``changed`` paths.
+
+        Return the paths of the files rendered.
+        """
+        sources = None
+        if changed is not None:
+            if changed & (self.configs() | self.directories()):
+                try:
+                    self.load()
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except Exception:
+                    logger.exception('Could not load %s.', self.config)
+                    return []
+            else:
+                sources = changed
+        rendered = []
+        for name, recipe in self.recipes:
+            def refresh():
+                return recipe.refresh(sources)
+            try:
+                paths = self.buildout[name]._call(refresh)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except zc.buildout.UserError:
+                logger.error('%s: %s', name, sys.exc_info()[1])
+                continue
+            except Exception:
+                logger.exception('Could not render the files of %s.', name)
+                continue
+            for rel_path in paths:
+                path = os.path.join(recipe.destination_dir, rel_path[:-3])
+                logger.info('Rendered %s.', path)
+                rendered.append(path)
+        return rendered
+
+
+def _config_files(path, found=None):
+    "Return the path of a configuration file and of those it extends."
+    if found is None:
+        found = set()
+    if path in found or not os.path.exists(path):
+        return found
+    found.add(path)
+    parser = RawConfigParser()
+    try:
+        parser.read(path)
+        extends = parser.get('buildout', 'extends')
+    except ConfigError:
+        return found
+    for extended in extends.split():
+        if '://' in extended:
+            continue # Not a file that can be watched.
+        _config_files(
+            os.path.normpath(os.path.join(os.path.dirname(path), extended)),
+            found)
+    return found
+
+
+def _signature(path):
+    """Return what changes when the file or directory at ``path`` changes.
+
+    Only templates and subdirectories are considered for directories, so
+    that files rendered in them are ignored.
+    """
+    try:
+        if os.path.isdir(path):
+            return sorted(
+                name for name in os.listdir(path) if name.endswith('.in') or
+                os.path.isdir(os.path.join(path, name)))
+        statinfo = os.stat(path)
+    except OSError:
+        return None
+    return (statinfo.st_mtime, statinfo.st_size)
+
+
+class PollingWatcher(object):
+    """Find changes by checking the watched paths at intervals."""
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.signatures = {}
+
+    def watch(self, paths):
+        "Watch ``paths``, and only them, from now on."
+        signatures = {}
+        for path in paths:
+            if path in self.signatures:
+                signatures[path] = self.signatures[path]
+            else:
+                signatures[path] = _signature(path)
+        self.signatures = signatures
+
+    def wait(self):
+        "Wait until watched paths change, and return them."
+        while True:
+            changed = set()
+            for path, signature in self.signatures.items():
+                current = _signature(path)
+                if current != signature:
+                    self.signatures[path] = current
+                    changed.add(path)
+            if changed:
+                return changed
+            time.sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Find changes with inotify, through pyinotify."""
+
+    # Files are often saved by writing a new file and renaming it.
+    mask = (getattr(pyinotify, 'IN_CLOSE_WRITE', 0) |
+            getattr(pyinotify, 'IN_MOVED_TO', 0) |
+            getattr(pyinotify, 'IN_MOVED_FROM', 0) |
+            getattr(pyinotify, 'IN_CREATE', 0) |
+            getattr(pyinotify, 'IN_DELETE', 0))
+
+    # Milliseconds without events after which a change is complete.
+    settle = 100
+
+    def __init__(self):
+        self.manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.manager, self._event)
+        self.paths = set()
+        self.watched = {} # directory -> watch descriptor
+        self.changed = set()
+
+    def watch(self, paths):
+        "Watch ``paths``, and only them, from now on."
+        self.paths = set(paths)
+        directories = set(
+            os.path.isdir(path) and path or os.path.dirname(path)
+            for path in self.paths)
+        for directory in set(self.watched) - directories:
+            self.manager.rm_watch(self.watched.pop(directory))
+        for directory in directories - set(self.watched):
+            if os.path.isdir(directory):
+                self.watched.update(
+                    self.manager.add_watch(directory, self.mask))
+
+    def _event(self, event):
+        if event.pathname in self.paths:
+            self.changed.add(event.pathname)
+        elif event.path in self.paths and (
+            event.dir or event.name.endswith('.in')):
+            self.changed.add(event.path)
+
+    def wait(self):
+        "Wait until watched paths change, and return them."
+        timeout = None
+        while True:
+            if self.notifier.check_events(timeout):
+                self.notifier.read_events()
+                self.notifier.process_events()
+                if self.changed:
+                    timeout = self.settle
+            elif self.changed:
+                changed, self.changed = self.changed, set()
+                return changed
+
+    def close(self):
+        self.notifier.stop()
+
+
+def watch(session, watcher, cycles=None):
+    """Keep the files of the session up to date, using the watcher.
+
+    Files are first brought up to date.  Then, ``cycles`` changes are
+    handled, or changes are handled forever if it is None.
+    """
+    session.refresh()
+    while cycles is None or cycles > 0:
+        watcher.watch(session.paths())
+        session.refresh(watcher.wait())
+        if cycles is not None:
+            cycles -= 1
+
+
+def main(args=None):
+    parser = optparse.OptionParser(
+        usage='%prog [options] [part ...]',
+        description='Render the files of the parts of a buildout that use '
+        'z3c.recipe.filetemplate again when their templates or the '
+        'configuration change.')
+    parser.add_option('-c', '--config', default='buildout.cfg',
+                      help='The buildout configuration file.  The default is '
+                      'buildout.cfg.')
+    parser.add_option('-p', '--poll', action='store_true',
+                      help='Poll for changes, even if pyinotify is installed.')
+    parser.add_option('-i', '--interval', type='float', default=0.5,
+                      help='Seconds between polls.  The default is 0.5.')
+    options, parts = parser.parse_args(args)
+    if options.poll or pyinotify is None:
+        watcher = PollingWatcher(options.interval)
+    else:
+        watcher = InotifyWatcher()
+    here = os.getcwd()
+    try:
+        try:
+            watch(Session(options.config, parts), watcher)
+        except KeyboardInterrupt:
+            pass
+    finally:
+        watcher.close()
+        os.chdir(here) # Buildout changes to its directory.
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())